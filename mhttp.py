@@ -1,7 +1,25 @@
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import email.utils
+import errno
+import hashlib
+import http
+import json
+import mimetypes
+import os
+import random
+import re
 import socket
+import selectors
+import signal
+import stat
+import threading
 import time
 import ssl
-import gzip
+import urllib.parse
+import zlib
 
 
 default_get_header = {}
@@ -29,8 +47,50 @@ port_of_proto = {
 }
 
 RECV_MAXSIZE = 4096
+UPLOAD_CHUNK_SIZE = 65536
 
-redirect_codes = [300, 301, 302, 303]
+# Server limits
+SERVER_MAX_HEADER_SIZE = 65536
+SERVER_MAX_BODY_SIZE = 16 * 1024 * 1024
+
+# Response cache memory limit, in bytes
+CACHE_MAXSIZE = 64 * 1024 * 1024
+
+# Permanent redirects kept, and redirects followed per request
+REDIRECT_CACHE_SIZE = 1024
+REDIRECT_MAX_HOPS = 10
+
+# DNS cache lifetimes, in seconds
+DNS_CACHE_TTL = 60
+DNS_NEGATIVE_TTL = 5
+
+# Delay before racing the next address of a host, in seconds (RFC 8305)
+HAPPY_EYEBALLS_DELAY = 0.25
+
+# Connection pool limits
+POOL_MAXSIZE_PER_HOST = 8
+POOL_IDLE_TIMEOUT = 60
+
+# Buffers per sendmsg call
+SENDMSG_MAX_BUFFERS = 1024
+
+# WebSocket message size limit, in bytes, and smallest compressed message
+WS_MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+WS_COMPRESS_MIN_SIZE = 64
+
+# Segmented downloads: smallest segment, in bytes, and interval between
+# saves of the resume state, in seconds
+DOWNLOAD_MIN_SEGMENT_SIZE = 1024 * 1024
+DOWNLOAD_STATE_INTERVAL = 1
+
+# Request durations kept per host for the percentiles of ClientStats
+STATS_SAMPLES_PER_HOST = 1024
+
+redirect_codes = [300, 301, 302, 303, 307, 308]
+permanent_redirect_codes = (301, 308)
+# keep_alive of the hops of a request without keep-alive: the connection is
+# only kept for a next hop on the same origin
+keep_alive_redirect = 'redirect'
 
 _sslcontext = ssl.create_default_context()
 
@@ -39,28 +99,80 @@ def bytesDecode(data):
     return data.decode('utf-8', errors='ignore')
 
 def remTrailingSpace(a):
-    i = 0
-    m = len(a)
+    return a.strip(' ')
 
-    while i < m and a[i] == ' ': i += 1
 
-    out = ""
-    tmp = ""
-    while i < m:
-        c = a[i]
-        if c == ' ':
-            tmp += c
-        else:
-            if tmp:
-                out += tmp
-                tmp = ""
-            out += c
-        i += 1
-    
-    return out
+# DNS cache
+class DNSCache():
+    # Thread-safe cache of getaddrinfo results. Failed lookups are cached for
+    # negative_ttl. Each lookup rotates the address list so connections are
+    # spread round-robin over every A/AAAA record of a host.
+    def __init__(self, ttl=DNS_CACHE_TTL, negative_ttl=DNS_NEGATIVE_TTL, family=socket.AF_UNSPEC):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.family = family
+        self.entries = {}  # (host, port) -> [expire time, addresses or error, next index]
+        self.lock = threading.Lock()
+
+    def get(self, host, port):
+        # Cached addresses as (family, sockaddr) tuples, or None on a miss
+        with self.lock:
+            entry = self.entries.get((host, port))
+            if entry is None:
+                return None
+            if time.monotonic() > entry[0]:
+                del self.entries[(host, port)]
+                return None
+            addrs = entry[1]
+            if isinstance(addrs, Exception):
+                raise socket.gaierror(*addrs.args)
+            start = entry[2]
+            entry[2] = (start + 1) % len(addrs)
+        return addrs[start:] + addrs[:start]
+
+    def lookup(self, host, port):
+        try:
+            infos = socket.getaddrinfo(host, port, self.family, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            with self.lock:
+                self.entries[(host, port)] = [time.monotonic() + self.negative_ttl, e, 0]
+            raise
+        addrs = []
+        for family, _, _, _, sockaddr in infos:
+            if (family, sockaddr) not in addrs:
+                addrs.append((family, sockaddr))
+        with self.lock:
+            self.entries[(host, port)] = [time.monotonic() + self.ttl, addrs, 1 % len(addrs)]
+        return addrs
+
+    def resolve(self, host, port):
+        addrs = self.get(host, port)
+        if addrs is None:
+            addrs = self.lookup(host, port)
+        return addrs
 
+    def clear(self):
+        with self.lock:
+            self.entries = {}
 
-def parseURL(url):
+dns_cache = DNSCache()
+
+def interleaveAddresses(addrs):
+    # Alternates address families, starting with the first one returned by
+    # the resolver, so a broken family is left behind after one attempt
+    families = collections.OrderedDict()
+    for addr in addrs:
+        families.setdefault(addr[0], collections.deque()).append(addr)
+    result = []
+    while families:
+        for family in list(families):
+            result.append(families[family].popleft())
+            if not families[family]:
+                del families[family]
+    return result
+
+
+def parseURL(url, resolve=True):
     # Protocol
     protocol = 'http'
     start_pos = url.find('://')
@@ -94,16 +206,25 @@ def parseURL(url):
             username = username[:pos]
             password = username[pos+1:]
     
-    # Port
+    # Unix domain socket, its percent-encoded path in place of the host
+    if protocol == 'http+unix':
+        return {'path':path, 'dns':dns, 'proto':protocol, 'ip':None, 'port':None, 'hascredentials':has_auth, 'password':password, 'username':username, 'unix_socket':urllib.parse.unquote(dns)}
+
+    # Port, IPv6 literals are enclosed in brackets
     pos = dns.rfind(':')
+    if pos < dns.rfind(']'):
+        pos = -1
     port = None
     if pos == -1 and (protocol in port_of_proto):
         port = port_of_proto[protocol]
     else:
         port = int(dns[pos+1:])
         dns = dns[:pos]
+    if dns.startswith('['):
+        dns = dns[1:-1]
     
-    return {'path':path, 'dns':dns, 'proto':protocol, 'ip':socket.gethostbyname(dns), 'port':port, 'hascredentials':has_auth, 'password':password, 'username':username}
+    ip = dns_cache.resolve(dns, port)[0][1][0] if resolve else None
+    return {'path':path, 'dns':dns, 'proto':protocol, 'ip':ip, 'port':port, 'hascredentials':has_auth, 'password':password, 'username':username, 'unix_socket':None}
 
 
 def parseSetCookieAttr(attr):
@@ -173,146 +294,247 @@ HTTP_STEP_METHOD   = 0x6
 HTTP_STEP_PATH     = 0x7
 HTTP_STEP_REQVER   = 0x8
 
-# Parse utils functions
-def parseUntilChar(txt, sep, i, m, ret):
-    while i < m:
-        c = txt[i]
-        if c == sep:
-            return ret, i+1, True
-        ret.append(c)
-        i += 1
-    return ret, i, False
-
-def parseUntilTwoChar(txt, sep1, sep2, i, m, ret):
-    x = m - 1
-    while i < x:
-        c = txt[i]
-        if c == sep1 and txt[i+1] == sep2:
-            return ret, i+2, True
-        ret.append(c)
-        i += 1
-    return ret, i, False
-
 # Common parse functions
-def parseHdrKey(rep, i, m, key):
-    return parseUntilChar(rep, ord(':'), i, m, key)
+def parseHdrLines(lines, hdrs):
+    for line in lines:
+        if line[:1] in (b' ', b'\t') and hdrs:
+            # Obsolete line folding, continuation of the previous value
+            k, v = hdrs[-1]
+            hdrs[-1] = (k, remTrailingSpace(v + ' ' + remTrailingSpace(bytesDecode(line).strip('\t'))))
+            continue
+        pos = line.find(b':')
+        if pos == -1:
+            continue
+        if isinstance(hdrs, Headers):
+            hdrs.addRaw(line[:pos], line[pos+1:])
+        else:
+            hdrs.append(( remTrailingSpace(bytesDecode(line[:pos]).lower()), remTrailingSpace(bytesDecode(line[pos+1:])) ))
+    return hdrs
 
-def parseHdrValue(rep, i, m, value):
-    return parseUntilTwoChar(rep, ord('\r'), ord('\n'), i, m, value)
+def parseHeaderBlock(rep, i, m, step, first_step, hdrs):
+    # Bulk scanning of a message head. Only complete lines are consumed, so
+    # when the head is not complete the parse is resumed on the next call
+    # from the first incomplete line. Returns the first line when it was
+    # parsed during this call, or None.
+    view = memoryview(rep)[:m]
+    first = None
+    try:
+        if i >= m:
+            return i, step, first, False
 
-def parseCheckEnd(rep, i, m):
-    if i < m-1:
-        if rep[i] == ord('\r') and rep[i+1] == ord('\n'):
-            return True, i+2, True
-        return False, i, True
-    return False, i, False
+        # Common case, the whole head is available
+        # After a resumed parse i follows the CRLF of the last consumed line
+        end = rep.find(b'\r\n\r\n', i if step == first_step else i - 2, m)
+        if end != -1:
+            if step == first_step:
+                pos = rep.find(b'\r\n', i, end)
+                if pos == -1: pos = end
+                first = bytes(view[i:pos])
+                i = min(pos + 2, end)
+            block = bytes(view[i:end])
+            if isinstance(hdrs, Headers) and b'\n ' not in block and b'\n\t' not in block and block[:1] not in (b' ', b'\t'):
+                hdrs.addBlock(block)
+            elif block:
+                parseHdrLines(block.split(b'\r\n'), hdrs)
+            return end + 4, HTTP_STEP_HDRKEY, first, True
+
+        # Partial head, consume complete lines only
+        while 1:
+            pos = rep.find(b'\r\n', i, m)
+            if pos == -1:
+                return i, step, first, False
+            line = bytes(view[i:pos])
+            i = pos + 2
+            if step == first_step:
+                first = line
+                step = HTTP_STEP_HDRKEY
+            elif not line:
+                return i, step, first, True
+            else:
+                parseHdrLines((line,), hdrs)
+    finally:
+        view.release()
 
 # Response parse functions
-def parseRepVersion(rep, i, m, version):
-    return parseUntilChar(rep, ord(' '), i, m, version)
+def parseRepHeader(rep, i, m, step, ver, code, msg, key, val, hdrs=[]):
+    i, step, first, complet = parseHeaderBlock(rep, i, m, step, HTTP_STEP_REPVER, hdrs)
+    if first is not None:
+        parts = first.split(b' ', 2)
+        ver = parts[0]
+        code = parts[1] if len(parts) > 1 else b''
+        msg = parts[2] if len(parts) > 2 else b''
+    return i, step, ver, code, msg, key, val, hdrs, complet
 
-def parseRepCode(rep, i, m, code):
-    return parseUntilChar(rep, ord(' '), i, m, code)
+# Request parse functions
+def parseReqHeader(rep, i, m, step, met, path, ver, key, val, hdrs=[]):
+    i, step, first, complet = parseHeaderBlock(rep, i, m, step, HTTP_STEP_METHOD, hdrs)
+    if first is not None:
+        parts = first.split(b' ', 2)
+        met = parts[0]
+        path = parts[1] if len(parts) > 1 else b''
+        ver = parts[2] if len(parts) > 2 else b''
+    return i, step, met, path, ver, key, val, hdrs, complet
 
-def parseRepMsg(rep, i, m, msg):
-    return parseUntilTwoChar(rep, ord('\r'), ord('\n'), i, m, msg)
 
-def parseRepHeader(rep, i, m, step, ver, code, msg, key, val, hdrs=[]):
-    complet = False
+# Header utils functions
+# One header field per line of a head without obsolete line folding. The
+# second form is for heads without whitespace before a colon or a line end,
+# which is most of them, and is several times faster.
+header_field_re = re.compile(r'^([^:\r\n]+?)[ \t]*:[ \t]*(.*?)[ \t]*\r?$', re.M)
+header_field_fast_re = re.compile(r'^([^:\r\n]+):[ \t]*([^\r\n]*)', re.M)
 
-    while not complet:
-        if   step == HTTP_STEP_REPVER:
-            ver, i, finish = parseRepVersion(rep, i, m, ver)
-            if finish: step = HTTP_STEP_REPCODE
-            else: break
-        
-        elif step == HTTP_STEP_REPCODE:
-            code, i, finish = parseRepCode(rep, i, m, code)
-            if finish: step = HTTP_STEP_REPMSG
-            else: break
-        
-        elif step == HTTP_STEP_REPMSG:
-            msg, i, finish = parseRepMsg(rep, i, m, msg)
-            if finish: step = HTTP_STEP_CHECKEND
-            else: break
-        
-        elif step == HTTP_STEP_CHECKEND:
-            complet, i, finish = parseCheckEnd(rep, i, m)
-            if finish: step = HTTP_STEP_HDRKEY
-            else: break
-        
-        elif step == HTTP_STEP_HDRKEY:
-            key, i, finish = parseHdrKey(rep, i, m, key)
-            if finish: step = HTTP_STEP_HDRVALUE
-            else: break
-        
-        elif step == HTTP_STEP_HDRVALUE:
-            val, i, finish = parseHdrValue(rep, i, m, val)
-            if finish:
-                step = HTTP_STEP_CHECKEND
-                hdrs.append(( remTrailingSpace(bytesDecode(key).lower()), remTrailingSpace(bytesDecode(val)) ))
-                key.clear()
-                val.clear()
-            else: break
-    
-    return i, step, ver, code, msg, key, val, hdrs, complet
+class Headers():
+    # Header fields in order, duplicates included, with a case-insensitive
+    # index. Used for requests and responses. Iterating and indexing by
+    # position give (lowercase name, value) tuples like the header lists
+    # used before. items() gives the names as they were set, and indexing
+    # by name works as a dict. A received head is decoded and split in one
+    # pass, and the index is only built on the first lookup.
+    def __init__(self, fields=None):
+        self.names = []   # names as set
+        self.lowers = []  # lowercase names
+        self.values = []
+        self.index = {}   # lowercase name -> first position, None until built
+        if fields is not None:
+            self.update(fields)
 
-# Request parse functions
-def parseReqMethod(rep, i, m, method):
-    return parseUntilChar(rep, ord(' '), i, m, method)  
+    def add(self, name, value):
+        lower = name.lower()
+        if self.index is not None:
+            self.index.setdefault(lower, len(self.names))
+        self.names.append(name)
+        self.lowers.append(lower)
+        self.values.append(value)
 
-def parseReqPath(rep, i, m, path):
-    return parseUntilChar(rep, ord(' '), i, m, path) 
+    def addRaw(self, name, value):
+        # name and value of a received line, bytes
+        self.add(remTrailingSpace(bytesDecode(name)), remTrailingSpace(bytesDecode(value)))
 
-def parseReqVersion(rep, i, m, version):
-    return parseUntilTwoChar(rep, ord('\r'), ord('\n'), i, m, version)
+    def addBlock(self, block):
+        # Header lines of a received head, bytes without obsolete folding
+        text = bytesDecode(block)
+        if ' \r' in text or '\t\r' in text or ' :' in text or '\t:' in text or text[-1:] in (' ', '\t'):
+            fields = header_field_re.findall(text)
+        else:
+            fields = header_field_fast_re.findall(text)
+        if not fields:
+            return
+        names, values = zip(*fields)
+        self.names += names
+        self.values += values
+        self.lowers += '\n'.join(names).lower().split('\n')
+        self.index = None
 
-def parseReqHeader(rep, i, m, step, met, path, ver, key, val, hdrs=[]):
-    complet = False
+    def append(self, field):
+        self.add(field[0], field[1])
 
-    while not complet and i < m:
-        if   step == HTTP_STEP_METHOD:
-            met, i, finish = parseReqMethod(rep, i, m, met)
-            if finish: step = HTTP_STEP_PATH
-            else: break
-        
-        elif step == HTTP_STEP_PATH:
-            path, i, finish = parseReqPath(rep, i, m, path)
-            if finish: step = HTTP_STEP_REQVER
-            else: break
-        
-        elif step == HTTP_STEP_REQVER:
-            ver, i, finish = parseReqVersion(rep, i, m, ver)
-            if finish: step = HTTP_STEP_CHECKEND
-            else: break
-        
-        elif step == HTTP_STEP_CHECKEND:
-            complet, i, finish = parseCheckEnd(rep, i, m)
-            if finish: step = HTTP_STEP_HDRKEY
-            else: break
-        
-        elif step == HTTP_STEP_HDRKEY:
-            key, i, finish = parseHdrKey(rep, i, m, key)
-            if finish: step = HTTP_STEP_HDRVALUE
-            else: break
-        
-        elif step == HTTP_STEP_HDRVALUE:
-            val, i, finish = parseHdrValue(rep, i, m, val)
-            if finish:
-                step = HTTP_STEP_CHECKEND
-                hdrs.append(( remTrailingSpace(bytesDecode(key).lower()), remTrailingSpace(bytesDecode(val)) ))
-                key.clear()
-                val.clear()
-            else: break
-    
-    return i, step, met, path, ver, key, val, hdrs, complet
+    def update(self, fields):
+        if hasattr(fields, 'items'):
+            fields = fields.items()
+        for name, value in fields:
+            self.add(name, value)
 
+    def getIndex(self):
+        if self.index is None:
+            n = len(self.lowers)
+            self.index = dict(zip(reversed(self.lowers), range(n - 1, -1, -1)))
+        return self.index
+
+    def get(self, name, default=None):
+        i = self.getIndex().get(name.lower())
+        return default if i is None else self.values[i]
+
+    def getAll(self, name):
+        lower = name.lower()
+        i = self.getIndex().get(lower)
+        if i is None:
+            return []
+        return [self.values[j] for j in range(i, len(self.lowers)) if self.lowers[j] == lower]
+
+    def setdefault(self, name, value):
+        if name.lower() not in self.getIndex():
+            self.add(name, value)
+        return self.get(name)
+
+    def pop(self, name, default=None):
+        value = self.get(name, default)
+        if name.lower() in self.getIndex():
+            del self[name]
+        return value
+
+    def items(self):
+        return list(zip(self.names, self.values))
+
+    def keys(self):
+        return [self.names[i] for i in sorted(self.getIndex().values())]
+
+    def copy(self):
+        headers = Headers()
+        headers.names = list(self.names)
+        headers.lowers = list(self.lowers)
+        headers.values = list(self.values)
+        headers.index = None
+        return headers
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return zip(self.lowers, self.values)
+
+    def __contains__(self, item):
+        if isinstance(item, str):
+            return item.lower() in self.getIndex()
+        return item in list(self)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            i = self.getIndex().get(key.lower())
+            if i is None:
+                raise KeyError(key)
+            return self.values[i]
+        if isinstance(key, slice):
+            return list(self)[key]
+        return self.lowers[key], self.values[key]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, str):
+            if key.lower() in self.getIndex():
+                del self[key]
+            self.add(key, value)
+            return
+        self.names[key], self.values[key] = value
+        self.lowers[key] = value[0].lower()
+        self.index = None
+
+    def __delitem__(self, key):
+        if isinstance(key, str):
+            lower = key.lower()
+            if lower not in self.getIndex():
+                raise KeyError(key)
+            keep = [i for i in range(len(self.names)) if self.lowers[i] != lower]
+        else:
+            keep = list(range(len(self.names)))
+            del keep[key]
+        self.names = [self.names[i] for i in keep]
+        self.lowers = [self.lowers[i] for i in keep]
+        self.values = [self.values[i] for i in keep]
+        self.index = None
+
+    def __eq__(self, other):
+        if isinstance(other, (Headers, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Headers(%r)' % self.items()
 
-# Header utils functions
 def addHeader(headers, key, value):
     headers.append((key.lower(), value))
 
 def hasHeader(header, key):
+    if isinstance(header, Headers):
+        return key.lower() in header.getIndex()
     key = key.lower()
     for k, _ in header:
         if k == key:
@@ -320,6 +542,8 @@ def hasHeader(header, key):
     return False
 
 def getHeaderValue(header, key):
+    if isinstance(header, Headers):
+        return header.get(key)
     key = key.lower()
     for k, v in header:
         if k == key:
@@ -330,6 +554,8 @@ def getHeader(headers, key):
     return getHeaderValue(headers, key)
 
 def getHeaderValues(header, key):
+    if isinstance(header, Headers):
+        return header.getAll(key)
     key = key.lower()
     vals = []
     for k, v in header:
@@ -338,262 +564,3686 @@ def getHeaderValues(header, key):
     return vals
 
 
-# Main HTTP class
-class HTTP():
-    def __init__(self, s=None, keep_alive=False):
-        self.sockets = {}
-        self.defaultkeepalive = keep_alive
-        self.recv_callback = None
-    
-    def recvTimeout(self, s, packet_size, timeout):
-        s.setblocking(0)
-        end_time = time.time()+timeout
-        data = b''
-        while not data:
-            try:
-                data = s.recv(packet_size)
-            except:
-                pass
-            if time.time() > end_time:
-                break
-        return data
+# Content decoders
+class GzipDecoder():
+    def __init__(self):
+        self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
 
+    def decompress(self, data):
+        out = self.obj.decompress(data)
+        # Concatenated gzip members
+        while self.obj.eof and self.obj.unused_data:
+            data = self.obj.unused_data
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out += self.obj.decompress(data)
+        return out
 
-    def readResponse(self, s):
-        step, version, repcode, repmsg, key, val, headers = HTTP_STEP_REPVER, bytearray(), bytearray(), bytearray(), bytearray(), bytearray(), []
-        complet = False
-        data = bytearray()
-        body = bytearray()
-        
-        i = 0
-        while not complet:
-            x = s.recv( RECV_MAXSIZE )
-            if not x: break
-            data += x
-            i, step, version, repcode, repmsg, key, val, headers, complet = parseRepHeader(data, i, len(data), step, version, repcode, repmsg, key, val, headers)
+    def flush(self):
+        return self.obj.flush()
 
-        if complet:
-            if i < len(data):
-                body = data[i:]
-            repcode = int(repcode)
-            return False, bytesDecode(version), int(repcode), bytesDecode(repmsg), headers, body
+class DeflateDecoder():
+    # "deflate" should be zlib wrapped data but some servers send raw deflate
+    def __init__(self):
+        self.obj = zlib.decompressobj()
+        self.first = True
 
-        return True, None, None, None, None, None
-    
-    def readRequest(self, s):
-        step, version, method, path, key, val, headers = HTTP_STEP_METHOD, b'', b'', b'', b'', b'', []
-        complet = False
-        data = b''
-        body = b''
-        
-        i = 0
-        while not complet:
-            x = s.recv( RECV_MAXSIZE )
-            if not x: break
-            data += x
-            i, step, method, path, version, key, val, headers, complet = parseReqHeader(data, i, len(data), step, method, path, version, key, val, headers)
+    def decompress(self, data):
+        if not self.first:
+            return self.obj.decompress(data)
+        self.first = False
+        try:
+            return self.obj.decompress(data)
+        except zlib.error:
+            self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.obj.decompress(data)
 
-        if complet and i < len(data):
-            body = data[i:]
-            return False, bytesDecode(method), bytesDecode(path), bytesDecode(version), headers, body
+    def flush(self):
+        return self.obj.flush()
 
-        return True, None, None, None, None, None
+def newDecoder(headers):
+    encoding = getHeader(headers, 'content-encoding')
+    if encoding is None:
+        return None
+    encoding = encoding.lower()
+    if encoding in ("gzip", "x-gzip"):
+        return GzipDecoder()
+    if encoding == "deflate":
+        return DeflateDecoder()
+    if encoding != "identity":
+        print("HTTP: Warning: Unsuported content encoding: " + encoding)
+    return None
 
-    def readBody(self, s, headers, body):
-        # Read all body
-        if getHeader(headers, 'transfer-encoding') == 'chunked':
-            body = self.recvAllChunked(s, body)
-        elif hasHeader(headers, 'content-length'):
-            bodylen = int( getHeader(headers, 'content-length') )
-            if len(body) < bodylen:
-                body += self.recvAllSized(s, bodylen - len(body))
-        else:
-            body += self.recvAllTimeout(s)
-        
-        # Decompress when body encoded
-        if body and hasHeader(headers, 'content-encoding'):
-            encoding = getHeader(headers, 'content-encoding')
-            if encoding == "gzip":
-                body = gzip.decompress( body )
+
+# Body utils functions
+def parseChunkedBody(data, i):
+    # Decodes a complete chunked body starting at i. Returns the body and the
+    # position following it, or None, None when more data is needed.
+    body = bytearray()
+    m = len(data)
+    while 1:
+        pos = data.find(b'\r\n', i)
+        if pos == -1: return None, None
+        chunk_len = int(bytes(data[i:pos]).split(b';', 1)[0], 16)
+        i = pos + 2
+        if chunk_len == 0:
+            # Skip trailers up to the empty line
+            while 1:
+                pos = data.find(b'\r\n', i)
+                if pos == -1: return None, None
+                if pos == i: return body, i + 2
+                i = pos + 2
+        if m < i + chunk_len + 2: return None, None
+        body += data[i:i+chunk_len]
+        i += chunk_len + 2
+
+def decodeBody(headers, body):
+    # Decompress when body encoded
+    if body:
+        decoder = newDecoder(headers)
+        if decoder is not None:
+            body = decoder.decompress(body) + decoder.flush()
+    return body
+
+def hasNoBody(method, repcode):
+    return method == 'HEAD' or repcode in (204, 304) or (repcode is not None and 100 <= repcode < 200)
+
+def isBodyDelimited(headers):
+    return getHeader(headers, 'transfer-encoding') == 'chunked' or hasHeader(headers, 'content-length')
+
+def canKeepAlive(headers, keep_alive, method=None, repcode=None):
+    if not keep_alive or getHeader(headers, 'connection') == 'close':
+        return False
+    return hasNoBody(method, repcode) or isBodyDelimited(headers)
+
+
+# Upload utils functions
+def isStreamBody(data):
+    # File objects and iterators of bytes are sent without being buffered
+    return data is not None and not isinstance(data, (bytes, bytearray, memoryview, str))
+
+def getStreamLength(data):
+    # Remaining size of a seekable file, None when it is unknown
+    if not hasattr(data, 'read'):
+        return None
+    try:
+        st = os.fstat(data.fileno())
+        if stat.S_ISREG(st.st_mode):
+            return max(st.st_size - data.tell(), 0)
+    except (AttributeError, OSError, ValueError):
+        pass
+    try:
+        if data.seekable():
+            pos = data.tell()
+            end = data.seek(0, os.SEEK_END)
+            data.seek(pos)
+            return end - pos
+    except (AttributeError, OSError, ValueError):
+        pass
+    return None
+
+def getStreamPosition(data):
+    # Position to rewind a file to before sending it again, None when the
+    # body can't be sent twice
+    try:
+        if hasattr(data, 'seekable') and data.seekable():
+            return data.tell()
+    except (OSError, ValueError):
+        pass
+    return None
+
+def iterStreamChunks(data):
+    if hasattr(data, 'read'):
+        chunks = iter(lambda: data.read(UPLOAD_CHUNK_SIZE), b'')
+    else:
+        chunks = data
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf8')
+        if chunk:
+            yield chunk
+
+
+def sendParts(sock, parts):
+    # Sends the buffers in parts with as few sendmsg calls as possible,
+    # without joining them. SSL sockets don't support sendmsg.
+    views = [memoryview(part).cast('B') for part in parts if len(part)]
+    if not hasattr(sock, 'sendmsg'):
+        for view in views:
+            sock.sendall(view)
+        return
+    while views:
+        try:
+            n = sock.sendmsg(views[:SENDMSG_MAX_BUFFERS])
+        except NotImplementedError:
+            for view in views:
+                sock.sendall(view)
+            return
+        while n:
+            if n >= len(views[0]):
+                n -= len(views.pop(0))
             else:
-                print("HTTP: Warning: Unsuported content encoding: " + encoding)
-        
-        return body
+                views[0] = views[0][n:]
+                n = 0
 
 
-    def recvAllSized(self, s, total_size):
-        actual_size = 0
-        data = b''
-        while actual_size < total_size:
-            temp_data = s.recv(min(4096, total_size-actual_size))
-            actual_size += len(temp_data)
-            data += temp_data
-        return data
+# Request utils functions
+def prepareRequest(url_infos, method, keep_alive, header, data):
+    if header is None:
+        header = Headers(default_post_header if method == "POST" else default_get_header)
+    else:
+        header = Headers(header)
+
+    header['Host'] = getHost(url_infos)
+    header['Connection'] = "keep-alive" if keep_alive else "close"
     
-    def recvAllChunked(self, s, last_part=None):
-        actual_size = 0
-        data = b''
-        temp_data = b''
-        if last_part != None: temp_data = last_part
-        cursor = 0
-        part = 0
-        chunk_hdr = ''
-        chunk_len = 0
-        start_of_chunk = 0
-        recv_len = len(temp_data)
-        while 1:
-            if cursor >= len(temp_data)-1:
-                d = s.recv(4096)
-                if not d: return data
-                temp_data += d
-                recv_len = len(temp_data)
-            else:
-                if part == 0:
-                    if temp_data[cursor:cursor+2] != b'\r\n':
-                        chunk_hdr += chr(temp_data[cursor])
-                        cursor += 1
-                    else:
-                        chunk_len = int(chunk_hdr, 16)
-                        if chunk_len == 0: return data
-                        part = 1
-                        cursor += 2
-                        start_of_chunk = cursor
-                
-                elif part == 1:
-                    already_read = cursor-start_of_chunk
-                    if recv_len-cursor < chunk_len-already_read:
-                        data += temp_data[cursor:]
-                        cursor += recv_len-cursor
-                    else:
-                        data += temp_data[cursor:start_of_chunk+chunk_len]
-                        cursor += chunk_len-already_read+2
-                        part = 0
-                        chunk_hdr = ''
-                        
-    def recvAllTimeout(self, s):
-        data = b''
-        temp_data = self.recvTimeout(s, 4096, 0.05)
-        while temp_data:
-            data += temp_data
-            temp_data = self.recvTimeout(s, 4096, 0.05)
+    if isStreamBody(data):
+        length = getStreamLength(data)
+        if length is None:
+            header["Transfer-Encoding"] = "chunked"
+        else:
+            header["Content-Length"] = str(length)
+    elif data != None:
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.encode('utf8')
+        header["Content-Length"] = str(len(data))
+
+    return header, data
+
+def convertBody(body, body_type=bytes):
+    # body_type: bytes, bytearray or memoryview, the last two avoid a copy
+    # when the body is already a bytearray
+    if body_type is bytes:
+        return bytes(body)
+    if body_type is bytearray:
+        return body if isinstance(body, bytearray) else bytearray(body)
+    if body_type is memoryview:
+        return memoryview(body)
+    raise ValueError("HTTP: Unsupported body type: " + str(body_type))
+
+def formatHost(dns):
+    # Brackets IPv6 literals
+    return '[%s]' % dns if ':' in dns else dns
+
+def getHost(url_infos):
+    # Host header value, with the port when it is not the default one
+    if url_infos['proto'] == 'http+unix':
+        return 'localhost'
+    port = '' if port_of_proto.get(url_infos['proto']) == url_infos['port'] else ':%d' % url_infos['port']
+    return formatHost(url_infos['dns']) + port
+
+def getBaseURL(url_infos):
+    if url_infos['proto'] == 'http+unix':
+        return url_infos['proto']+'://'+url_infos['dns']
+    return url_infos['proto']+'://'+getHost(url_infos)
+
+def getURL(url_infos):
+    return getBaseURL(url_infos)+url_infos['path']
+
+def getCacheURL(url_infos):
+    # getURL, followed by the Unix socket the request goes through if the
+    # url does not name it
+    url = getURL(url_infos)
+    if url_infos.get('unix_socket') is not None and url_infos['proto'] != 'http+unix':
+        return url + ' unix:' + url_infos['unix_socket']
+    return url
+
+def getRequestHeader(header, key):
+    # Request headers are Headers, or a dict with keys in any case
+    if isinstance(header, Headers):
+        return header.get(key)
+    key = key.lower()
+    for k in header:
+        if k.lower() == key:
+            return header[k]
+    return None
+
+# Encoded lines of the constant default headers by (name, value). Other
+# lines, credentials and per request values among them, are never kept.
+header_lines = {}
+for _header in (default_get_header, default_post_header, {'Connection': 'keep-alive'}, {'Connection': 'close'}):
+    for _name, _value in _header.items():
+        header_lines[(_name, _value)] = (_name + ': ' + _value + '\r\n').encode('ascii')
+
+def encodeHeaderLine(name, value):
+    line = header_lines.get((name, value))
+    if line is None:
+        line = (name + ': ' + value + '\r\n').encode('ascii')
+    return line
+
+def getRedirectLocation(rep, last_url):
+    # Absolute location of a redirect, relative to last_url, without fragment
+    if rep is not None and rep['repcode'] in redirect_codes and hasHeader(rep['header'], 'Location'):
+        loc = getHeader(rep['header'], 'Location')
+        if last_url.startswith('http+unix://') and not urllib.parse.urlsplit(loc).scheme:
+            # urljoin only knows the hierarchy of the registered schemes
+            return 'http+unix' + urllib.parse.urljoin('http' + last_url[9:], loc).partition('#')[0][4:]
+        return urllib.parse.urljoin(last_url, loc).partition('#')[0]
+    return None
+
+def getRedirectMethod(repcode, method):
+    # 307 and 308 keep the method and body, 303 turns into GET, and 301 and
+    # 302 too after a POST, as every client does
+    if repcode == 303 and method != 'HEAD':
+        return 'GET'
+    if repcode in (301, 302) and method == 'POST':
+        return 'GET'
+    return method
+
+def isSameOriginRedirect(rep, url_infos):
+    loc = getRedirectLocation(rep, getURL(url_infos))
+    if loc is None:
+        return False
+    try:
+        next_infos = parseURL(loc, resolve=False)
+    except ValueError:
+        return False
+    return poolKey(next_infos)[:3] == poolKey(url_infos)[:3]
+
+def prepareRedirect(rep, url_infos, method, header, data):
+    # Next request of a redirect as (url_infos, method, header, data), or
+    # None when rep is not a redirect
+    loc = getRedirectLocation(rep, getURL(url_infos))
+    if loc is None:
+        return None
+    next_infos = parseURL(loc, resolve=False)
+    if next_infos['unix_socket'] is None and poolKey(next_infos)[:3] == poolKey(url_infos)[:3]:
+        next_infos['unix_socket'] = url_infos.get('unix_socket')
+    next_method = getRedirectMethod(rep['repcode'], method)
+    header = Headers(header)
+    if next_method != method:
+        data = None
+        for name in ('Content-Length', 'Transfer-Encoding', 'Content-Type'):
+            header.pop(name)
+    if poolKey(next_infos) != poolKey(url_infos):
+        # Credentials are not sent to another origin
+        for name in ('Authorization', 'Cookie', 'Proxy-Authorization'):
+            header.pop(name)
+    header['Host'] = getHost(next_infos)
+    return next_infos, next_method, header, data
+
+class RedirectCache():
+    # Permanent redirects (301, 308) seen, so later requests go straight to
+    # the final URL. LRU of maxsize entries (url, unix socket) -> (location,
+    # code, unix socket of the location). A 301 is only followed by GET and
+    # HEAD requests since it may change the method of the others.
+    def __init__(self, maxsize=REDIRECT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def store(self, url, rep, unix_socket=None):
+        # unix_socket: the Unix socket the request to url went through, kept
+        # by the location when it is on the same origin like prepareRedirect
+        if 'no-store' in parseCacheControl(getHeader(rep['header'], 'cache-control')):
+            return
+        loc = getRedirectLocation(rep, url)
+        if loc is None:
+            return
+        # Normalized like the urls looked up, so chains of hops resolve
+        loc_infos = parseURL(loc, resolve=False)
+        loc = getURL(loc_infos)
+        loc_socket = loc_infos['unix_socket']
+        if loc_socket is None and poolKey(loc_infos)[:3] == poolKey(parseURL(url, resolve=False))[:3]:
+            loc_socket = unix_socket
+        key = (url, unix_socket)
+        if key == (loc, loc_socket):
+            return
+        with self.lock:
+            self.entries[key] = (loc, rep['repcode'], loc_socket)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def resolve(self, url, method, unix_socket=None):
+        # Final URL of the cached redirects from url, its Unix socket and the
+        # hop count. The urls are normalized by getURL.
+        hops = 0
+        with self.lock:
+            while hops < REDIRECT_MAX_HOPS:
+                entry = self.entries.get((url, unix_socket))
+                if entry is None or (entry[1] == 301 and method not in ('GET', 'HEAD')):
+                    break
+                self.entries.move_to_end((url, unix_socket))
+                url, unix_socket = entry[0], entry[2]
+                hops += 1
+        return url, unix_socket, hops
+
+    def remove(self, url, unix_socket=None):
+        with self.lock:
+            self.entries.pop((url, unix_socket), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Timeouts
+class HTTPTimeout(TimeoutError):
+    pass
+
+class ConnectTimeout(HTTPTimeout):
+    pass
+
+class ReadTimeout(HTTPTimeout):
+    pass
+
+class TotalTimeout(HTTPTimeout):
+    pass
+
+class Timeout():
+    # connect: limit for establishing a connection, TLS handshake included
+    # read: limit for each wait on the socket (sending or receiving)
+    # total: limit for the whole request, redirects included
+    def __init__(self, connect=None, read=None, total=None):
+        self.connect = connect
+        self.read = read
+        self.total = total
+
+def toTimeout(timeout):
+    # A plain number applies to both connect and read
+    if isinstance(timeout, Timeout):
+        return timeout
+    if timeout is None:
+        return Timeout()
+    return Timeout(timeout, timeout)
+
+class Deadline():
+    def __init__(self, timeout):
+        self.timeout = toTimeout(timeout)
+        self.end = None if self.timeout.total is None else time.monotonic() + self.timeout.total
+
+    def expired(self):
+        return self.end is not None and time.monotonic() >= self.end
+
+    def remaining(self, limit):
+        # Timeout for the next wait, limit being the connect or read timeout
+        if self.end is None:
+            return limit
+        left = self.end - time.monotonic()
+        if left <= 0:
+            raise TotalTimeout("HTTP: Total timeout of %ss exceeded" % self.timeout.total)
+        return left if limit is None else min(limit, left)
+
+    def error(self, connecting=False):
+        if self.expired():
+            return TotalTimeout("HTTP: Total timeout of %ss exceeded" % self.timeout.total)
+        if connecting:
+            return ConnectTimeout("HTTP: Connect timed out after %ss" % self.timeout.connect)
+        return ReadTimeout("HTTP: Read timed out after %ss" % self.timeout.read)
+
+class DeadlineSocket():
+    # Socket wrapper giving every wait on the socket the read timeout, bounded
+    # by what remains of the total timeout. The socket timeout is implemented
+    # by the interpreter with poll, nothing spins.
+    def __init__(self, sock, deadline):
+        self.sock = sock
+        self.deadline = deadline
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def call(self, func, *args):
+        self.sock.settimeout(self.deadline.remaining(self.deadline.timeout.read))
+        try:
+            return func(*args)
+        except socket.timeout:
+            raise self.deadline.error() from None
+
+    def recv(self, *args):
+        data = self.call(self.sock.recv, *args)
+        self.bytes_in += len(data)
         return data
-    
 
-    def formatRequest(self, method, path, header, data):
-        ret = b''
-        out = '%s %s HTTP/1.1\r\n'%(method, path)
-        for k in header:
-            out += k + ': ' + header[k] + '\r\n'
-        out += '\r\n'
-        ret += out.encode('ascii')
-        if data is not None:
-            ret += data
-        return ret
+    def recv_into(self, *args):
+        n = self.call(self.sock.recv_into, *args)
+        self.bytes_in += n
+        return n
 
-    def formatResponse(self, code, msg_code, header, data):
-        ret = b''
-        out = 'HTTP/1.1 %s %s\r\n'%(str(code), msg_code)
-        for k in header:
-            out += k + ': ' + header[k] + '\r\n'
-        out += '\r\n'
-        ret += out.encode('ascii')
-        if data != None: ret += data.encode('utf8')
-        return ret
-    
+    def send(self, *args):
+        n = self.call(self.sock.send, *args)
+        self.bytes_out += n
+        return n
 
-    def closeAllConnection(self):
-        for sock in self.sockets.values():
-            if sock is not None:
-                sock.close()
+    def sendall(self, data, *args):
+        self.call(self.sock.sendall, data, *args)
+        self.bytes_out += memoryview(data).nbytes
 
-    def closeConnection(self, sock, dns):
-        if sock is not None:
-            sock.close()
-        if dns in self.sockets:
-            del self.sockets[dns]
-    
+    def sendmsg(self, *args):
+        n = self.call(self.sock.sendmsg, *args)
+        self.bytes_out += n
+        return n
 
-    def newSocket(self, use_ssl=False, hostname=None):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if use_ssl:
-            sock = _sslcontext.wrap_socket(sock, server_hostname=hostname)
-        return sock
+    def sendfile(self, *args, **kwargs):
+        n = self.call(lambda: self.sock.sendfile(*args, **kwargs))
+        self.bytes_out += n
+        return n
 
 
-    def _request(self, url_infos, method, keep_alive, timeout, header, data):
-        use_ssl = True if url_infos['proto'] == 'https' else False
-        dns = url_infos['dns']
+# TLS settings
+class TLSConfig():
+    # TLS settings of one or more origins. The sessions of the connections
+    # made with it are kept per (host, port) and offered again on the next
+    # handshake for an abbreviated handshake.
+    def __init__(self, cafile=None, capath=None, cadata=None, certfile=None, keyfile=None, password=None, verify=True, check_hostname=True, alpn=('http/1.1',), context=None):
+        if context is None:
+            context = ssl.create_default_context(cafile=cafile, capath=capath, cadata=cadata)
+            if certfile is not None:
+                context.load_cert_chain(certfile, keyfile, password)
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            elif not check_hostname:
+                context.check_hostname = False
+            if alpn:
+                context.set_alpn_protocols(list(alpn))
+        self.context = context
+        self.sessions = {}  # (host, port) -> SSLSession
+        self.lock = threading.Lock()
+
+    def getSession(self, host, port):
+        with self.lock:
+            return self.sessions.get((host, port))
+
+    def saveSession(self, host, port, sock):
+        session = sock.session
+        if session is not None:
+            with self.lock:
+                self.sessions[(host, port)] = session
+
+    def clearSessions(self):
+        with self.lock:
+            self.sessions = {}
+
+
+# Connection pool
+def poolKey(url_infos):
+    return (url_infos['proto'], url_infos['dns'], url_infos['port'], url_infos.get('unix_socket'))
+
+def isSocketAlive(sock):
+    # An idle keep-alive socket must not be readable: readable means the
+    # server closed it (EOF) or sent unexpected data, both unusable.
+    try:
+        if sock.fileno() < 0:
+            return False
+        if isinstance(sock, ssl.SSLSocket) and sock.pending():
+            return False
+        with selectors.DefaultSelector() as selector:
+            selector.register(sock, selectors.EVENT_READ)
+            return not selector.select(0)
+    except (OSError, ValueError):
+        return False
+
+class ConnectionPool():
+    def __init__(self, maxsize_per_host=POOL_MAXSIZE_PER_HOST, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.maxsize_per_host = maxsize_per_host
+        self.idle_timeout = idle_timeout
+        self.idle = {}  # key -> list of (sock, release time), most recent last
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        now = time.monotonic()
+        dead = []
         sock = None
-        request = self.formatRequest(method, url_infos['path'], header, data)
+        with self.lock:
+            conns = self.idle.get(key)
+            while conns:
+                s, released = conns.pop()
+                if self.idle_timeout is not None and now - released > self.idle_timeout:
+                    dead.append(s)
+                    continue
+                sock = s
+                break
+        for s in dead:
+            s.close()
+        if sock is not None and not isSocketAlive(sock):
+            sock.close()
+            return self.acquire(key)
+        return sock
+
+    def release(self, key, sock):
+        if isinstance(sock, DeadlineSocket):
+            sock = sock.sock
+        sock.settimeout(None)
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxsize_per_host:
+                conns.append((sock, time.monotonic()))
+                return
+        sock.close()
+
+    def prune(self):
+        now = time.monotonic()
+        dead = []
+        with self.lock:
+            for key in list(self.idle):
+                alive = []
+                for s, released in self.idle[key]:
+                    if self.idle_timeout is not None and now - released > self.idle_timeout:
+                        dead.append(s)
+                    else:
+                        alive.append((s, released))
+                if alive: self.idle[key] = alive
+                else: del self.idle[key]
+        for s in dead:
+            s.close()
+
+    def clear(self, key=None):
+        with self.lock:
+            if key is None:
+                conns = [c for l in self.idle.values() for c in l]
+                self.idle = {}
+            else:
+                conns = self.idle.pop(key, [])
+        for s, _ in conns:
+            s.close()
+
+
+# Response cache
+def parseCacheControl(value):
+    directives = {}
+    if value:
+        for item in value.split(','):
+            name, _, arg = item.strip().partition('=')
+            if name:
+                directives[name.lower()] = arg.strip('"') if arg else None
+    return directives
+
+def parseHTTPDate(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
 
-        # Send HTTP request
-        if dns in self.sockets and self.sockets[dns] is not None:
-            sock = self.sockets[dns]
+cacheable_codes = (200, 203, 300, 301, 308, 404, 410)
+
+class ResponseCache():
+    # Private HTTP cache of GET responses. Entries live in memory in LRU
+    # order up to maxsize bytes, and are also written to the directory path
+    # when given. Freshness comes from Cache-Control max-age or Expires, and
+    # stale entries with an ETag or Last-Modified are revalidated. Only the
+    # last variant of each url is kept, a request whose Vary headers differ
+    # from it is a miss.
+    def __init__(self, maxsize=CACHE_MAXSIZE, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.entries = collections.OrderedDict()  # url -> entry
+        self.size = 0
+        self.lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def diskPath(self, url):
+        return os.path.join(self.path, hashlib.sha256(url.encode('utf8')).hexdigest())
+
+    def loadDisk(self, url):
+        path = self.diskPath(url)
+        try:
+            with open(path + '.json', 'r') as f:
+                entry = json.load(f)
+            with open(path + '.body', 'rb') as f:
+                entry['body'] = f.read()
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        entry['header'] = [tuple(h) for h in entry['header']]
+        return entry
+
+    def saveDisk(self, entry):
+        path = self.diskPath(entry['url'])
+        meta = dict(entry)
+        del meta['body']
+        try:
+            with open(path + '.body.tmp', 'wb') as f:
+                f.write(entry['body'])
+            with open(path + '.json.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(path + '.body.tmp', path + '.body')
+            os.replace(path + '.json.tmp', path + '.json')
+        except OSError as e:
+            print("HTTP: Warning: can't write cache entry: " + str(e))
+
+    def removeDisk(self, url):
+        path = self.diskPath(url)
+        for ext in ('.json', '.body'):
             try:
-                sock.send( request )
-            except ConnectionResetError:
-                sock = self.newSocket(use_ssl, dns)
-                sock.connect((dns, url_infos['port']))
-                sock.send( request )
-        else:
-            sock = self.newSocket(use_ssl, dns)
-            sock.connect((dns, url_infos['port']))
-            sock.send( request )
-        
-        # Read HTTP response
-        error, version, repcode, repmsg, headers, body  = self.readResponse(sock)
-        if error: return None
+                os.remove(path + ext)
+            except OSError:
+                pass
 
-        body = self.readBody(sock, headers, body)
-        
-        if getHeader(headers, 'connection') == 'close' or not keep_alive:
-            self.closeConnection(sock, dns)
-        
-        return {'version': version, 'repcode': repcode, 'repmsg': repmsg, 'header': headers, 'body': bytes(body)}
+    def put(self, entry):
+        with self.lock:
+            old = self.entries.pop(entry['url'], None)
+            if old is not None:
+                self.size -= old['size']
+            if entry['size'] <= self.maxsize:
+                self.entries[entry['url']] = entry
+                self.size += entry['size']
+            while self.size > self.maxsize:
+                _, old = self.entries.popitem(last=False)
+                self.size -= old['size']
+        if self.path is not None:
+            self.saveDisk(entry)
 
+    def remove(self, url):
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old is not None:
+                self.size -= old['size']
+        if self.path is not None:
+            self.removeDisk(url)
 
-    def request(self, url, method="GET", keep_alive=None, timeout=6, follow_redirect=True, header=None, data=None):
-        method = method.upper()
+    def lookup(self, url, header):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+        if entry is None and self.path is not None:
+            entry = self.loadDisk(url)
+            if entry is not None:
+                with self.lock:
+                    if url not in self.entries and entry['size'] <= self.maxsize:
+                        self.entries[url] = entry
+                        self.size += entry['size']
+        if entry is None:
+            return None
+        for name, value in entry['vary'].items():
+            if getRequestHeader(header, name) != value:
+                return None
+        return entry
 
-        if header is None:
-            if method == "POST": header = default_post_header.copy()
-            else: header = default_get_header.copy()
+    def isFresh(self, entry, header):
+        cc = parseCacheControl(getRequestHeader(header, 'Cache-Control'))
+        if 'no-cache' in cc or entry['no_cache']:
+            return False
+        return time.time() < entry['expires']
 
-        if keep_alive is None:
-            keep_alive = self.defaultkeepalive
-        
-        url_infos = parseURL(url)
+    def addValidators(self, entry, header):
+        header = header.copy()
+        etag = getHeader(entry['header'], 'etag')
+        modified = getHeader(entry['header'], 'last-modified')
+        if etag is not None:
+            header['If-None-Match'] = etag
+        if modified is not None:
+            header['If-Modified-Since'] = modified
+        return header
 
-        header['Host'] = url_infos['dns']
-        header['Connection'] = "keep-alive" if keep_alive else "close"
-        
-        if data != None:
-            if data is not bytes:
-                data = data.encode('utf8')
-            header["Content-Length"] = str(len(data))
+    def makeEntry(self, url, header, rep, now):
+        # Returns the cache entry of a response, None when it must not be
+        # stored
+        if rep['repcode'] not in cacheable_codes:
+            return None
+        cc = parseCacheControl(getHeader(rep['header'], 'cache-control'))
+        if 'no-store' in cc or 'no-store' in parseCacheControl(getRequestHeader(header, 'Cache-Control')):
+            return None
 
-        rep = self._request(url_infos, method, keep_alive, timeout, header, data)
-        last_base_url = url_infos['proto']+'://'+url_infos['dns']
+        lifetime = None
+        if 'max-age' in cc:
+            try:
+                lifetime = int(cc['max-age'])
+            except (TypeError, ValueError):
+                lifetime = 0
+        elif hasHeader(rep['header'], 'expires'):
+            expires = parseHTTPDate(getHeader(rep['header'], 'expires'))
+            date = parseHTTPDate(getHeader(rep['header'], 'date') or '') or now
+            lifetime = expires - date if expires is not None else 0
+        has_validator = hasHeader(rep['header'], 'etag') or hasHeader(rep['header'], 'last-modified')
+        if lifetime is None and not has_validator:
+            return None
+        try:
+            age = int(getHeader(rep['header'], 'age') or 0)
+        except ValueError:
+            age = 0
 
-        if follow_redirect:
-            while 1:
-                if rep['repcode'] in redirect_codes and hasHeader(rep['header'], 'Location'):
-                    loc = getHeader(rep['header'], 'Location')
-                    if loc[0] == '/':
-                        loc = last_base_url + loc
-                    url_infos = parseURL(loc)
-                    last_base_url = url_infos['proto']+'://'+url_infos['dns']
-                    
-                    #print("Redirect to: "+loc)
-                    rep = self._request(url_infos, method, keep_alive, timeout, header, data)
-                else:
-                    break
-        return rep
+        vary = {}
+        for names in getHeaderValues(rep['header'], 'vary'):
+            for name in names.split(','):
+                name = name.strip().lower()
+                if name == '*':
+                    return None
+                if name:
+                    vary[name] = getRequestHeader(header, name)
 
+        body = bytes(rep['body'])
+        return {
+            'url': url,
+            'version': rep['version'],
+            'repcode': rep['repcode'],
+            'repmsg': rep['repmsg'],
+            'header': list(rep['header']),
+            'body': body,
+            'vary': vary,
+            'expires': now + (lifetime or 0) - age,
+            'no_cache': 'no-cache' in cc or lifetime is None,
+            'size': len(body) + sum(len(k) + len(v) for k, v in rep['header']) + 256
+        }
 
+    def store(self, url, header, rep):
+        entry = self.makeEntry(url, header, rep, time.time())
+        if entry is None:
+            self.remove(url)
+        else:
+            self.put(entry)
 
-# Test code
-'''
-http = HTTP()
-print( http.request("https://httpbin.org/get") )
+    def revalidated(self, entry, rep):
+        # Updates an entry from a 304 response
+        names = set(k for k, _ in rep['header'] if k not in ('content-length', 'transfer-encoding', 'connection'))
+        merged = dict(entry)
+        merged['header'] = [(k, v) for k, v in entry['header'] if k not in names] + [(k, v) for k, v in rep['header'] if k in names]
+        fresh = self.makeEntry(entry['url'], {}, dict(merged, repcode=entry['repcode']), time.time())
+        if fresh is not None:
+            merged['expires'] = fresh['expires']
+            merged['no_cache'] = fresh['no_cache']
+            merged['size'] = fresh['size']
+            self.put(merged)
+        return merged
+
+    def toResponse(self, entry, body_type=bytes):
+        return {'version': entry['version'], 'repcode': entry['repcode'], 'repmsg': entry['repmsg'], 'header': Headers(entry['header']), 'body': convertBody(entry['body'], body_type), 'cached': True}
+
+    def clear(self):
+        with self.lock:
+            urls = list(self.entries)
+            self.entries.clear()
+            self.size = 0
+        if self.path is not None:
+            for name in os.listdir(self.path):
+                if name.endswith('.json') or name.endswith('.body'):
+                    try:
+                        os.remove(os.path.join(self.path, name))
+                    except OSError:
+                        pass
+
+
+# Client metrics
+class ClientStats():
+    # Aggregates request events per host: counts, errors, bytes in and out,
+    # connection reuse and total duration percentiles over the last
+    # samples requests. Cache hits are counted but not sampled, the
+    # percentiles are those of the network. Callable, so it can be
+    # registered as a hook.
+    def __init__(self, samples=STATS_SAMPLES_PER_HOST):
+        self.samples = samples
+        self.hosts = {}  # host -> statistics
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            host = self.hosts.get(event['host'])
+            if host is None:
+                host = {'requests': 0, 'errors': 0, 'reused': 0, 'cached': 0, 'bytes_in': 0, 'bytes_out': 0, 'durations': collections.deque(maxlen=self.samples)}
+                self.hosts[event['host']] = host
+            host['requests'] += 1
+            if event['error'] is not None:
+                host['errors'] += 1
+            if event['reused']:
+                host['reused'] += 1
+            host['bytes_in'] += event['bytes_in']
+            host['bytes_out'] += event['bytes_out']
+            if event['cached']:
+                host['cached'] += 1
+            else:
+                host['durations'].append(event['timings']['total'])
+
+    def count(self, host):
+        # Number of durations sampled for host
+        with self.lock:
+            return len(self.hosts[host]['durations']) if host in self.hosts else 0
+
+    def percentile(self, p, host=None):
+        # p in [0, 100], None when no request was recorded
+        with self.lock:
+            if host is None:
+                durations = [d for h in self.hosts.values() for d in h['durations']]
+            elif host in self.hosts:
+                durations = list(self.hosts[host]['durations'])
+            else:
+                durations = []
+        if not durations:
+            return None
+        durations.sort()
+        return durations[min(len(durations) - 1, int(len(durations) * p / 100))]
+
+    def summary(self, host=None):
+        # Statistics of host, or of all hosts when None
+        with self.lock:
+            hosts = list(self.hosts.values()) if host is None else [self.hosts[host]] if host in self.hosts else []
+            result = {name: sum(h[name] for h in hosts) for name in ('requests', 'errors', 'reused', 'cached', 'bytes_in', 'bytes_out')}
+        result['reuse_ratio'] = result['reused'] / result['requests'] if result['requests'] else 0.0
+        for p in (50, 95, 99):
+            result['p%d' % p] = self.percentile(p, host)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.hosts.clear()
+
+
+# Retries and hedging
+idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT', 'DELETE')
+safe_methods = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+class RetryBudget():
+    # Token bucket limiting retries to a ratio of the requests, so retries
+    # don't multiply the load of an overloaded upstream. It holds at most
+    # reserve tokens, every request deposits ratio and every retry takes one.
+    def __init__(self, ratio=0.2, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = float(reserve)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class Retry():
+    # Retries of failed requests: after one of exceptions, an incomplete
+    # response, or one of status_codes. The n-th retry waits
+    # backoff * 2 ** n seconds up to max_backoff, with full jitter, or what
+    # Retry-After asks for. Retries stop after total, at the request
+    # deadline, or when budget (a shared RetryBudget) is empty.
+    def __init__(self, total=3, backoff=0.1, max_backoff=10, jitter=True, status_codes=(429, 502, 503, 504), exceptions=(ConnectionError, HTTPTimeout), methods=idempotent_methods, retry_after=True, budget=None):
+        self.total = total
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.status_codes = status_codes
+        self.exceptions = exceptions
+        self.methods = methods
+        self.retry_after = retry_after
+        self.budget = budget
+
+    def isRetryable(self, method, rep=None, error=None):
+        if method not in self.methods:
+            return False
+        if error is not None:
+            return isinstance(error, self.exceptions) and not isinstance(error, TotalTimeout)
+        return rep is None or rep['repcode'] in self.status_codes
+
+    def getDelay(self, attempt, rep=None):
+        if self.retry_after and rep is not None:
+            value = getHeader(rep['header'], 'retry-after')
+            if value is not None:
+                value = value.strip()
+                if value.isdigit():
+                    return min(int(value), self.max_backoff)
+                date = parseHTTPDate(value)
+                if date is not None:
+                    return min(max(0, date - time.time()), self.max_backoff)
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return random.uniform(0, delay) if self.jitter else delay
+
+class Hedge():
+    # Hedged requests: when a safe request without body got no response
+    # after delay seconds, or the given percentile of the host durations
+    # once HTTP.stats has min_samples of them, a duplicate is sent on
+    # another connection, up to max_hedges times. The first response wins.
+    def __init__(self, delay=None, percentile=95, min_samples=20, max_hedges=1, methods=safe_methods):
+        self.delay = delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_hedges = max_hedges
+        self.methods = methods
+
+    def getDelay(self, stats, host):
+        if self.delay is not None:
+            return self.delay
+        if stats.count(host) < self.min_samples:
+            return None
+        return stats.percentile(self.percentile, host)
+
+def discardResponse(future):
+    # Done callback of a losing hedged attempt
+    if future.exception() is None and future.result() is not None and future.result().get('stream') is not None:
+        future.result()['stream'].close()
+
+def startThread(func, *args):
+    # Runs func in a daemon thread, returns a concurrent.futures.Future
+    future = concurrent.futures.Future()
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+# Single-flight of identical requests
+class Flight():
+    # Request in progress, shared by the callers that asked for it meanwhile
+    def __init__(self):
+        self.future = concurrent.futures.Future()
+        self.followers = 0
+
+class SharedStream():
+    # Body stream read once from the connection and replayed to every
+    # caller of a coalesced request. The connection is closed once every
+    # reader has been closed before the end of the body.
+    def __init__(self, stream, readers):
+        self.stream = stream
+        self.readers = readers
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.lock = threading.Lock()
+
+    def get(self, i):
+        # Chunk i, None at the end of the body
+        with self.lock:
+            while i >= len(self.chunks) and not self.done:
+                try:
+                    self.chunks.append(next(self.stream))
+                except StopIteration:
+                    self.done = True
+                except BaseException as e:
+                    self.error = e
+                    self.done = True
+            if i < len(self.chunks):
+                return self.chunks[i]
+            if self.error is not None:
+                raise self.error
+            return None
+
+    def release(self):
+        with self.lock:
+            self.readers -= 1
+            if self.readers > 0 or self.done:
+                return
+        self.stream.close()
+
+class SharedStreamReader():
+    # BodyStream interface over a SharedStream
+    def __init__(self, shared):
+        self.shared = shared
+        self.index = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        data = self.shared.get(self.index)
+        if data is None:
+            self.close()
+            raise StopIteration
+        self.index += 1
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self):
+        return b''.join(self)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.shared.release()
+
+def shareResponse(rep):
+    # Copy of a coalesced response for one of its callers
+    if rep is None:
+        return None
+    rep = dict(rep)
+    rep['header'] = rep['header'].copy()
+    # Mutable bodies are copied, bytes are shared
+    body = rep.get('body')
+    if isinstance(body, bytearray):
+        rep['body'] = bytearray(body)
+    elif isinstance(body, memoryview) and not body.readonly:
+        rep['body'] = memoryview(bytearray(body))
+    if isinstance(rep.get('stream'), SharedStream):
+        rep['stream'] = SharedStreamReader(rep['stream'])
+    return rep
+
+def releaseShare(future):
+    # Done callback releasing the share of a caller that stopped waiting
+    if future.exception() is None and future.result() is not None and isinstance(future.result().get('stream'), SharedStream):
+        future.result()['stream'].release()
+
+
+# Streamed response body
+class BodyStream():
+    # Iterator over the decoded chunks of a response body read directly from
+    # the connection. The connection goes back to the pool once the body has
+    # been read entirely, and is closed when the stream is closed before.
+    def __init__(self, http, sock, key, headers, body, method=None, repcode=None, keep_alive=False, chunk_size=65536):
+        self.http = http
+        self.sock = sock
+        self.key = key
+        self.chunk_size = chunk_size
+        self.reusable = canKeepAlive(headers, keep_alive, method, repcode)
+        self.decoder = newDecoder(headers)
+        self.closed = False
+        self.raw = self.iterRaw(headers, body, method, repcode)
+        self.event = None  # request event, see HTTP._request
+        self.start = None
+        self.body_start = time.perf_counter()
+        self.decompress_time = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.closed:
+            try:
+                data = next(self.raw)
+            except StopIteration:
+                start = time.perf_counter()
+                tail = self.decoder.flush() if self.decoder is not None else b''
+                self.decompress_time += time.perf_counter() - start
+                self.finish(self.reusable)
+                if tail: return tail
+                break
+            except BaseException as e:
+                if self.event is not None:
+                    self.event['error'] = e
+                self.finish(False)
+                raise
+            if self.decoder is not None:
+                start = time.perf_counter()
+                data = self.decoder.decompress(data)
+                self.decompress_time += time.perf_counter() - start
+            if data:
+                return data
+        raise StopIteration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self):
+        return b''.join(self)
+
+    def close(self):
+        if not self.closed:
+            self.finish(False)
+
+    def finish(self, reusable):
+        self.closed = True
+        if self.event is not None:
+            timings = self.event['timings']
+            timings['decompress'] = self.decompress_time
+            timings['download'] = time.perf_counter() - self.body_start - self.decompress_time
+            self.http.finishEvent(self.event, self.sock, self.start)
+        if reusable:
+            self.http.pool.release(self.key, self.sock)
+        else:
+            self.http.closeConnection(self.sock, self.key)
+        self.sock = None
+
+    def recvMore(self, buf):
+        d = self.sock.recv(self.chunk_size)
+        if not d:
+            self.reusable = False
+            return False
+        buf += d
+        return True
+
+    def iterRaw(self, headers, body, method, repcode):
+        s = self.sock
+        if hasNoBody(method, repcode):
+            if body: self.reusable = False
+            return
+
+        if getHeader(headers, 'transfer-encoding') == 'chunked':
+            buf = bytearray(body)
+            while 1:
+                # Chunk size line
+                pos = buf.find(b'\r\n')
+                while pos == -1:
+                    if not self.recvMore(buf): return
+                    pos = buf.find(b'\r\n')
+                chunk_len = int(buf[:pos].split(b';', 1)[0], 16)
+                del buf[:pos+2]
+
+                # Last chunk, skip trailers up to the empty line
+                if chunk_len == 0:
+                    while 1:
+                        pos = buf.find(b'\r\n')
+                        if pos == -1:
+                            if not self.recvMore(buf): return
+                            continue
+                        del buf[:pos+2]
+                        if pos == 0:
+                            if buf: self.reusable = False
+                            return
+
+                # Chunk data
+                if buf:
+                    n = min(len(buf), chunk_len)
+                    yield bytes(buf[:n])
+                    del buf[:n]
+                    chunk_len -= n
+                while chunk_len:
+                    d = s.recv(min(self.chunk_size, chunk_len))
+                    if not d:
+                        self.reusable = False
+                        return
+                    chunk_len -= len(d)
+                    yield d
+
+                # Chunk CRLF
+                while len(buf) < 2:
+                    if not self.recvMore(buf): return
+                del buf[:2]
+
+        elif hasHeader(headers, 'content-length'):
+            remaining = int( getHeader(headers, 'content-length') )
+            if body:
+                if len(body) > remaining: self.reusable = False
+                data = bytes(body[:remaining])
+                remaining -= len(data)
+                yield data
+            while remaining:
+                d = s.recv(min(self.chunk_size, remaining))
+                if not d:
+                    self.reusable = False
+                    return
+                remaining -= len(d)
+                yield d
+
+        else:
+            # Body delimited by the connection close
+            self.reusable = False
+            if body:
+                yield bytes(body)
+            while 1:
+                d = s.recv(self.chunk_size)
+                if not d: return
+                yield d
+
+
+# WebSocket
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WS_OP_CONT, WS_OP_TEXT, WS_OP_BINARY, WS_OP_CLOSE, WS_OP_PING, WS_OP_PONG = 0, 1, 2, 8, 9, 10
+
+class WebSocketError(ValueError):
+    # Failed handshake or protocol violation, code being the close code
+    def __init__(self, msg, code=1002):
+        ValueError.__init__(self, msg)
+        self.code = code
+
+def websocketKey():
+    return base64.b64encode(os.urandom(16)).decode('ascii')
+
+def websocketAccept(key):
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode('ascii')).digest()).decode('ascii')
+
+def maskPayload(mask, payload):
+    # XOR of the whole payload as one integer, much faster than per byte
+    n = len(payload)
+    if not n:
+        return b''
+    mask = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(payload, 'little') ^ int.from_bytes(mask, 'little')).to_bytes(n, 'little')
+
+def formatFrame(opcode, payload, fin=True, rsv1=False, mask=True):
+    head = bytearray([(0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode])
+    n = len(payload)
+    bit = 0x80 if mask else 0
+    if n < 126:
+        head.append(bit | n)
+    elif n < 65536:
+        head.append(bit | 126)
+        head += n.to_bytes(2, 'big')
+    else:
+        head.append(bit | 127)
+        head += n.to_bytes(8, 'big')
+    if mask:
+        key = os.urandom(4)
+        return bytes(head) + key + maskPayload(key, payload)
+    return bytes(head) + payload
+
+def parseExtensions(value):
+    # Sec-WebSocket-Extensions as a list of (name, {param: value or None})
+    extensions = []
+    if value:
+        for item in value.split(','):
+            params = [p.strip() for p in item.split(';')]
+            args = {}
+            for param in params[1:]:
+                name, _, arg = param.partition('=')
+                args[name.strip().lower()] = arg.strip().strip('"') if arg else None
+            extensions.append((params[0].lower(), args))
+    return extensions
+
+class PerMessageDeflate():
+    # permessage-deflate extension (RFC 7692)
+    offer = 'permessage-deflate; client_max_window_bits'
+
+    def __init__(self, params):
+        for name in params:
+            if name not in ('server_no_context_takeover', 'client_no_context_takeover', 'server_max_window_bits', 'client_max_window_bits'):
+                raise WebSocketError("WebSocket: Unknown permessage-deflate parameter %s" % name)
+        self.compress_reset = 'client_no_context_takeover' in params
+        self.decompress_reset = 'server_no_context_takeover' in params
+        # zlib can't produce raw deflate with an 8 bits window
+        self.wbits = max(9, int(params.get('client_max_window_bits') or 15))
+        self.compressor = zlib.compressobj(wbits=-self.wbits)
+        self.decompressor = zlib.decompressobj(wbits=-15)
+
+    def compress(self, data):
+        data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.compress_reset:
+            self.compressor = zlib.compressobj(wbits=-self.wbits)
+        return data[:-4] if data.endswith(b'\x00\x00\xff\xff') else data
+
+    def decompress(self, data, max_size):
+        data = self.decompressor.decompress(data + b'\x00\x00\xff\xff', max_size + 1)
+        if len(data) > max_size:
+            raise WebSocketError("WebSocket: Message too big", 1009)
+        if self.decompress_reset:
+            self.decompressor = zlib.decompressobj(wbits=-15)
+        return data
+
+class WebSocketProtocol():
+    # Client side framing shared by WebSocket and AsyncWebSocket. Received
+    # bytes are fed in, complete messages are queued in messages and the
+    # frames to send back (pongs, close) in replies.
+    def __init__(self, deflate=None, max_size=WS_MAX_MESSAGE_SIZE, fragment_size=None):
+        self.deflate = deflate
+        self.max_size = max_size
+        self.fragment_size = fragment_size
+        self.buf = bytearray()
+        self.fragments = []
+        self.size = 0
+        self.opcode = None
+        self.compressed = False
+        self.messages = collections.deque()
+        self.replies = []
+        self.close_sent = False
+        self.close_received = False
+        self.close_code = None
+        self.close_reason = ''
+        self.last_pong = None
+
+    def encode(self, data, opcode=None):
+        # Frames of a message, str being sent as text and bytes as binary
+        if opcode is None:
+            opcode = WS_OP_TEXT if isinstance(data, str) else WS_OP_BINARY
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        compressed = False
+        if self.deflate is not None and len(data) >= WS_COMPRESS_MIN_SIZE:
+            data = self.deflate.compress(data)
+            compressed = True
+        size = self.fragment_size
+        if not size or len(data) <= size:
+            return formatFrame(opcode, data, rsv1=compressed)
+        frames = []
+        for i in range(0, len(data), size):
+            last = i + size >= len(data)
+            frames.append(formatFrame(opcode if i == 0 else WS_OP_CONT, data[i:i+size], last, compressed and i == 0))
+        return b''.join(frames)
+
+    def encodeClose(self, code=1000, reason=''):
+        self.close_sent = True
+        return formatFrame(WS_OP_CLOSE, code.to_bytes(2, 'big') + reason.encode('utf8') if code is not None else b'')
+
+    def feed(self, data):
+        self.buf += data
+        buf = self.buf
+        i = 0
+        while len(buf) - i >= 2:
+            b0, b1 = buf[i], buf[i+1]
+            fin, rsv, opcode, n = b0 & 0x80, b0 & 0x70, b0 & 0x0f, b1 & 0x7f
+            pos = i + 2
+            if n == 126:
+                if len(buf) < pos + 2: break
+                n = int.from_bytes(buf[pos:pos+2], 'big')
+                pos += 2
+            elif n == 127:
+                if len(buf) < pos + 8: break
+                n = int.from_bytes(buf[pos:pos+8], 'big')
+                pos += 8
+            mask = None
+            if b1 & 0x80:
+                if len(buf) < pos + 4: break
+                mask = bytes(buf[pos:pos+4])
+                pos += 4
+            if n > self.max_size:
+                raise WebSocketError("WebSocket: Message too big", 1009)
+            if len(buf) < pos + n: break
+            payload = bytes(buf[pos:pos+n])
+            if mask is not None:
+                payload = maskPayload(mask, payload)
+            i = pos + n
+            self.onFrame(fin, rsv, opcode, payload)
+        del buf[:i]
+
+    def onFrame(self, fin, rsv, opcode, payload):
+        if rsv & 0x30 or (rsv & 0x40 and (self.deflate is None or opcode >= 8 or opcode == WS_OP_CONT)):
+            raise WebSocketError("WebSocket: Unexpected reserved bits")
+        if opcode >= 8:
+            if not fin or len(payload) > 125:
+                raise WebSocketError("WebSocket: Invalid control frame")
+            if opcode == WS_OP_PING:
+                if not self.close_sent:
+                    self.replies.append(formatFrame(WS_OP_PONG, payload))
+            elif opcode == WS_OP_PONG:
+                self.last_pong = time.monotonic()
+            elif opcode == WS_OP_CLOSE:
+                self.close_received = True
+                if len(payload) >= 2:
+                    self.close_code = int.from_bytes(payload[:2], 'big')
+                    self.close_reason = payload[2:].decode('utf8', 'replace')
+                if not self.close_sent:
+                    self.replies.append(self.encodeClose(self.close_code if len(payload) >= 2 else None))
+            else:
+                raise WebSocketError("WebSocket: Unknown opcode %d" % opcode)
+            return
+
+        if opcode == WS_OP_CONT:
+            if self.opcode is None:
+                raise WebSocketError("WebSocket: Unexpected continuation frame")
+        elif opcode in (WS_OP_TEXT, WS_OP_BINARY):
+            if self.opcode is not None:
+                raise WebSocketError("WebSocket: Interleaved message")
+            self.opcode = opcode
+            self.compressed = bool(rsv & 0x40)
+        else:
+            raise WebSocketError("WebSocket: Unknown opcode %d" % opcode)
+        self.size += len(payload)
+        if self.size > self.max_size:
+            raise WebSocketError("WebSocket: Message too big", 1009)
+        self.fragments.append(payload)
+        if not fin:
+            return
+
+        data = b''.join(self.fragments)
+        if self.compressed:
+            data = self.deflate.decompress(data, self.max_size)
+        if self.opcode == WS_OP_TEXT:
+            try:
+                data = data.decode('utf8')
+            except UnicodeDecodeError:
+                raise WebSocketError("WebSocket: Invalid UTF-8 text", 1007) from None
+        self.messages.append(data)
+        self.fragments = []
+        self.size = 0
+        self.opcode = None
+
+class WebSocket():
+    # Blocking WebSocket client connection, see HTTP.websocket. recv returns
+    # the next message, str or bytes, or None once the connection is closed.
+    # Pings are answered while receiving. Sending is thread-safe.
+    def __init__(self, sock, protocol, data=b'', subprotocol=None, headers=None):
+        self.sock = sock
+        self.protocol = protocol
+        self.subprotocol = subprotocol
+        self.headers = headers
+        self.lock = threading.Lock()
+        self.closed = False
+        if data:
+            self.feed(data)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        msg = self.recv()
+        if msg is None:
+            raise StopIteration
+        return msg
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def sendRaw(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+    def send(self, data):
+        if self.protocol.close_sent:
+            raise ConnectionError("WebSocket: Connection closed")
+        self.sendRaw(self.protocol.encode(data))
+
+    def ping(self, data=b''):
+        self.sendRaw(formatFrame(WS_OP_PING, data))
+
+    def feed(self, data):
+        try:
+            self.protocol.feed(data)
+        except WebSocketError as e:
+            self.fail(e)
+            raise
+        replies, self.protocol.replies = self.protocol.replies, []
+        for reply in replies:
+            self.sendRaw(reply)
+
+    def fail(self, error):
+        try:
+            if not self.protocol.close_sent:
+                self.sendRaw(self.protocol.encodeClose(error.code))
+        except OSError:
+            pass
+        self.shutdown()
+
+    def recv(self, timeout=None):
+        # timeout: seconds to wait for a message, ReadTimeout when exceeded
+        protocol = self.protocol
+        end = None if timeout is None else time.monotonic() + timeout
+        while not protocol.messages:
+            if protocol.close_received or self.closed:
+                self.shutdown()
+                return None
+            left = None if end is None else end - time.monotonic()
+            if left is not None and left <= 0:
+                raise ReadTimeout("WebSocket: No message within %ss" % timeout)
+            self.sock.settimeout(left)
+            try:
+                data = self.sock.recv(RECV_MAXSIZE)
+            except (socket.timeout, BlockingIOError):
+                raise ReadTimeout("WebSocket: No message within %ss" % timeout) from None
+            except OSError:
+                data = b''
+            if not data:
+                self.shutdown()
+                return None
+            self.feed(data)
+        return protocol.messages.popleft()
+
+    def close(self, code=1000, reason='', timeout=5):
+        # Closing handshake, waits up to timeout for the close of the server
+        if self.closed:
+            return
+        try:
+            if not self.protocol.close_sent:
+                self.sendRaw(self.protocol.encodeClose(code, reason))
+            end = time.monotonic() + timeout
+            while not self.protocol.close_received:
+                left = end - time.monotonic()
+                if left <= 0:
+                    break
+                self.sock.settimeout(left)
+                data = self.sock.recv(RECV_MAXSIZE)
+                if not data:
+                    break
+                self.feed(data)
+                self.protocol.messages.clear()
+        except (OSError, WebSocketError):
+            pass
+        self.shutdown()
+
+    def shutdown(self):
+        if not self.closed:
+            self.closed = True
+            self.sock.close()
+
+class AsyncWebSocket():
+    # asyncio WebSocket client connection, see AsyncHTTP.websocket
+    def __init__(self, reader, writer, protocol, subprotocol=None, headers=None):
+        self.reader = reader
+        self.writer = writer
+        self.protocol = protocol
+        self.subprotocol = subprotocol
+        self.headers = headers
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self.recv()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def sendRaw(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def send(self, data):
+        if self.protocol.close_sent:
+            raise ConnectionError("WebSocket: Connection closed")
+        await self.sendRaw(self.protocol.encode(data))
+
+    async def ping(self, data=b''):
+        await self.sendRaw(formatFrame(WS_OP_PING, data))
+
+    async def feed(self, data):
+        try:
+            self.protocol.feed(data)
+        except WebSocketError as e:
+            try:
+                if not self.protocol.close_sent:
+                    await self.sendRaw(self.protocol.encodeClose(e.code))
+            except OSError:
+                pass
+            self.shutdown()
+            raise
+        replies, self.protocol.replies = self.protocol.replies, []
+        for reply in replies:
+            await self.sendRaw(reply)
+
+    async def recv(self, timeout=None):
+        protocol = self.protocol
+        while not protocol.messages:
+            if protocol.close_received or self.closed:
+                self.shutdown()
+                return None
+            try:
+                data = await asyncio.wait_for(self.reader.read(RECV_MAXSIZE), timeout)
+            except asyncio.TimeoutError:
+                raise ReadTimeout("WebSocket: No message within %ss" % timeout) from None
+            except OSError:
+                data = b''
+            if not data:
+                self.shutdown()
+                return None
+            await self.feed(data)
+        return protocol.messages.popleft()
+
+    async def close(self, code=1000, reason='', timeout=5):
+        if self.closed:
+            return
+        try:
+            if not self.protocol.close_sent:
+                await self.sendRaw(self.protocol.encodeClose(code, reason))
+            end = time.monotonic() + timeout
+            while not self.protocol.close_received:
+                data = await asyncio.wait_for(self.reader.read(RECV_MAXSIZE), max(0, end - time.monotonic()))
+                if not data:
+                    break
+                await self.feed(data)
+                self.protocol.messages.clear()
+        except (OSError, WebSocketError, asyncio.TimeoutError):
+            pass
+        self.shutdown()
+
+    def shutdown(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+def prepareWebSocket(url, header, subprotocols, compress, unix_socket=None):
+    # URL infos, with the scheme of the HTTP request, request headers and key
+    url_infos = parseURL(url, resolve=False)
+    url_infos['unix_socket'] = unix_socket
+    if url_infos['proto'] not in ('ws', 'wss'):
+        raise ValueError("WebSocket: Unsupported scheme %s" % url_infos['proto'])
+    url_infos['proto'] = 'https' if url_infos['proto'] == 'wss' else 'http'
+    header, _ = prepareRequest(url_infos, 'GET', True, header, None)
+    key = websocketKey()
+    header['Connection'] = 'Upgrade'
+    header['Upgrade'] = 'websocket'
+    header['Sec-WebSocket-Version'] = '13'
+    header['Sec-WebSocket-Key'] = key
+    if compress:
+        header['Sec-WebSocket-Extensions'] = PerMessageDeflate.offer
+    if subprotocols:
+        header['Sec-WebSocket-Protocol'] = ', '.join(subprotocols)
+    return url_infos, header, key
+
+def checkWebSocket(repcode, headers, key, subprotocols):
+    # Validates the handshake response, returns the deflate extension or
+    # None and the subprotocol
+    if repcode != 101:
+        raise WebSocketError("WebSocket: Handshake failed with status %s" % repcode)
+    if (getHeader(headers, 'upgrade') or '').lower() != 'websocket' or 'upgrade' not in (getHeader(headers, 'connection') or '').lower():
+        raise WebSocketError("WebSocket: Connection not upgraded")
+    if getHeader(headers, 'sec-websocket-accept') != websocketAccept(key):
+        raise WebSocketError("WebSocket: Invalid Sec-WebSocket-Accept")
+    deflate = None
+    for name, params in parseExtensions(getHeader(headers, 'sec-websocket-extensions')):
+        if name != 'permessage-deflate' or deflate is not None:
+            raise WebSocketError("WebSocket: Unexpected extension %s" % name)
+        deflate = PerMessageDeflate(params)
+    subprotocol = getHeader(headers, 'sec-websocket-protocol')
+    if subprotocol is not None and subprotocol not in (subprotocols or ()):
+        raise WebSocketError("WebSocket: Unexpected subprotocol %s" % subprotocol)
+    return deflate, subprotocol
+
+
+# Main HTTP class
+class HTTP():
+    def __init__(self, s=None, keep_alive=False, pool_maxsize=POOL_MAXSIZE_PER_HOST, pool_idle_timeout=POOL_IDLE_TIMEOUT, dns=None, cache=None, tls=None, retry=None, hedge=None, coalesce=True, redirects=None, unix_socket=None):
+        self.pool = ConnectionPool(pool_maxsize, pool_idle_timeout)
+        self.dns = dns_cache if dns is None else dns
+        self.cache = cache
+        self.tls = TLSConfig() if tls is None else tls
+        self.tls_origins = {}  # (host, port) -> TLSConfig
+        self.tls_stats = {}    # (host, port) -> handshake statistics
+        self.stats_lock = threading.Lock()
+        self.defaultkeepalive = keep_alive
+        self.recv_callback = None
+        self.stats = ClientStats()
+        self.hooks = [self.stats]
+        self.retry = retry  # default Retry of requests
+        self.hedge = hedge  # default Hedge of requests
+        self.coalesce = coalesce
+        self.redirects = RedirectCache() if redirects is None else redirects or None
+        self.unix_socket = unix_socket  # path of the Unix socket of every request
+        self.flights = {}  # request key -> Flight
+        self.flights_lock = threading.Lock()
+    
+    def readResponse(self, s, data=None):
+        # data: bytes already received from s, e.g. left over from the
+        # previous response on a pipelined connection
+        step, version, repcode, repmsg, key, val, headers = HTTP_STEP_REPVER, bytearray(), bytearray(), bytearray(), bytearray(), bytearray(), Headers()
+        complet = False
+        data = bytearray(data) if data else bytearray()
+        body = bytearray()
+        
+        i = 0
+        if data:
+            i, step, version, repcode, repmsg, key, val, headers, complet = parseRepHeader(data, i, len(data), step, version, repcode, repmsg, key, val, headers)
+        while not complet:
+            x = s.recv( RECV_MAXSIZE )
+            if not x: break
+            data += x
+            i, step, version, repcode, repmsg, key, val, headers, complet = parseRepHeader(data, i, len(data), step, version, repcode, repmsg, key, val, headers)
+
+        if complet:
+            if i < len(data):
+                body = data[i:]
+            repcode = int(repcode)
+            return False, bytesDecode(version), int(repcode), bytesDecode(repmsg), headers, body
+
+        return True, None, None, None, None, None
+    
+    def readRequest(self, s):
+        step, version, method, path, key, val, headers = HTTP_STEP_METHOD, b'', b'', b'', b'', b'', Headers()
+        complet = False
+        data = b''
+        body = b''
+        
+        i = 0
+        while not complet:
+            x = s.recv( RECV_MAXSIZE )
+            if not x: break
+            data += x
+            i, step, method, path, version, key, val, headers, complet = parseReqHeader(data, i, len(data), step, method, path, version, key, val, headers)
+
+        if complet and i < len(data):
+            body = data[i:]
+            return False, bytesDecode(method), bytesDecode(path), bytesDecode(version), headers, body
+
+        return True, None, None, None, None, None
+
+    def readBodyFramed(self, s, headers, body, method=None, repcode=None, timings=None):
+        # Returns the decoded body and the bytes received past its end.
+        # timings: dict receiving the 'decompress' duration
+        rest = b''
+        if hasNoBody(method, repcode):
+            return bytearray(), body
+
+        # Read all body
+        if getHeader(headers, 'transfer-encoding') == 'chunked':
+            body, rest = self.recvChunked(s, body)
+        elif hasHeader(headers, 'content-length'):
+            bodylen = int( getHeader(headers, 'content-length') )
+            if len(body) < bodylen:
+                body = self.recvSized(s, bodylen, body)
+            elif len(body) > bodylen:
+                rest = body[bodylen:]
+                body = body[:bodylen]
+        else:
+            body += self.recvAllUntilClose(s)
+        
+        start = time.perf_counter()
+        body = decodeBody(headers, body)
+        if timings is not None:
+            timings['decompress'] = time.perf_counter() - start
+        return body, rest
+
+    def readBody(self, s, headers, body, method=None, repcode=None, timings=None):
+        return self.readBodyFramed(s, headers, body, method, repcode, timings)[0]
+
+
+    def recvInto(self, s, view):
+        # Fills view from s, returns the number of bytes received
+        size = len(view)
+        n = 0
+        while n < size:
+            r = s.recv_into(view[n:], size - n)
+            if not r: break
+            n += r
+        return n
+
+    def recvSized(self, s, total_size, last_part=None):
+        # Receives into a buffer allocated once with the final size
+        data = bytearray(total_size)
+        n = 0
+        if last_part:
+            n = len(last_part)
+            data[:n] = last_part
+        with memoryview(data) as view:
+            n += self.recvInto(s, view[n:])
+        if n < total_size:
+            del data[n:]
+        return data
+
+    def recvAllSized(self, s, total_size):
+        return self.recvSized(s, total_size)
+    
+    def recvChunked(self, s, last_part=None):
+        # Returns the decoded body and the bytes received past its end. Chunk
+        # data missing from the receive buffer is received in place at the
+        # end of the body.
+        data = bytearray()
+        buf = bytearray(last_part) if last_part else bytearray()
+        while 1:
+            # Chunk size line
+            pos = buf.find(b'\r\n')
+            while pos == -1:
+                d = s.recv(RECV_MAXSIZE)
+                if not d: return data, b''
+                buf += d
+                pos = buf.find(b'\r\n')
+            chunk_len = int(buf[:pos].split(b';', 1)[0], 16)
+            del buf[:pos+2]
+
+            # Last chunk, skip trailers up to the empty line
+            if chunk_len == 0:
+                while 1:
+                    pos = buf.find(b'\r\n')
+                    if pos == -1:
+                        d = s.recv(RECV_MAXSIZE)
+                        if not d: return data, b''
+                        buf += d
+                        continue
+                    del buf[:pos+2]
+                    if pos == 0:
+                        return data, bytes(buf)
+
+            # Chunk data
+            avail = min(len(buf), chunk_len)
+            data += buf[:avail]
+            del buf[:avail]
+            missing = chunk_len - avail
+            if missing:
+                start = len(data)
+                data += bytes(missing)
+                with memoryview(data) as view:
+                    n = self.recvInto(s, view[start:])
+                if n < missing:
+                    del data[start+n:]
+                    return data, b''
+
+            # Chunk CRLF
+            while len(buf) < 2:
+                d = s.recv(RECV_MAXSIZE)
+                if not d: return data, b''
+                buf += d
+            del buf[:2]
+
+    def recvAllChunked(self, s, last_part=None):
+        return self.recvChunked(s, last_part)[0]
+
+    def recvAllUntilClose(self, s):
+        data = bytearray()
+        while 1:
+            temp_data = s.recv(UPLOAD_CHUNK_SIZE)
+            if not temp_data: return data
+            data += temp_data
+    
+
+    def formatRequest(self, method, path, header, data):
+        # Header lines come encoded from encodeHeaderLine. The body is best
+        # left out (None) and sent with sendRequest, which avoids a copy.
+        parts = [('%s %s HTTP/1.1\r\n'%(method, path)).encode('ascii')]
+        for k, v in header.items():
+            parts.append(encodeHeaderLine(k, v))
+        parts.append(b'\r\n')
+        if data is not None:
+            parts.append(data)
+        return b''.join(parts)
+
+    def formatResponse(self, code, msg_code, header, data):
+        parts = [('HTTP/1.1 %s %s\r\n'%(str(code), msg_code)).encode('ascii')]
+        for k, v in header.items():
+            parts.append(encodeHeaderLine(k, v))
+        parts.append(b'\r\n')
+        if data != None: parts.append(data if isinstance(data, (bytes, bytearray)) else data.encode('utf8'))
+        return b''.join(parts)
+    
+
+    def closeAllConnection(self):
+        self.pool.clear()
+
+    def closeConnection(self, sock, key=None):
+        if sock is not None:
+            sock.close()
+    
+
+    def newSocket(self, use_ssl=False, hostname=None, family=socket.AF_INET):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        # Head and body may be sent in separate writes
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if use_ssl:
+            sock = _sslcontext.wrap_socket(sock, server_hostname=hostname)
+        return sock
+
+
+    def setOriginTLS(self, host, config, port=443):
+        self.tls_origins[(host, port)] = config
+
+    def getTLSConfig(self, host, port):
+        return self.tls_origins.get((host, port), self.tls)
+
+    def getTLSStats(self):
+        # Per origin: full and resumed handshake counts and durations
+        with self.stats_lock:
+            return {origin: dict(stats) for origin, stats in self.tls_stats.items()}
+
+    def wrapTLS(self, sock, host, port):
+        # TLS handshake on a connected socket, resuming the last session of
+        # the origin when there is one
+        config = self.getTLSConfig(host, port)
+        start = time.perf_counter()
+        sock = config.context.wrap_socket(sock, server_hostname=host, session=config.getSession(host, port))
+        elapsed = time.perf_counter() - start
+        kind = 'resumed' if sock.session_reused else 'full'
+        with self.stats_lock:
+            stats = self.tls_stats.setdefault((host, port), {'full': 0, 'resumed': 0, 'full_time': 0.0, 'resumed_time': 0.0})
+            stats[kind] += 1
+            stats[kind + '_time'] += elapsed
+        return sock
+
+    def keepTLSSession(self, url_infos, sock):
+        # TLS 1.3 session tickets arrive after the handshake, so the session
+        # is saved once the response head has been read
+        sock = sock.sock if isinstance(sock, DeadlineSocket) else sock
+        if isinstance(sock, ssl.SSLSocket):
+            self.getTLSConfig(url_infos['dns'], url_infos['port']).saveSession(url_infos['dns'], url_infos['port'], sock)
+
+    def connectRace(self, addrs, deadline):
+        # Happy eyeballs: connection attempts to the addresses in turn, each
+        # started HAPPY_EYEBALLS_DELAY after the previous one, or as soon as
+        # it fails. The first connected socket is kept, the others closed.
+        limit = deadline.remaining(deadline.timeout.connect)
+        end = None if limit is None else time.monotonic() + limit
+        pending = collections.deque(interleaveAddresses(addrs))
+        attempts = {}  # sock -> sockaddr
+        winner = None
+        error = None
+        next_start = 0
+        selector = selectors.DefaultSelector()
+        try:
+            while pending or attempts:
+                now = time.monotonic()
+                if pending and now >= next_start:
+                    family, sockaddr = pending.popleft()
+                    sock = self.newSocket(False, None, family)
+                    sock.setblocking(False)
+                    attempts[sock] = sockaddr
+                    err = sock.connect_ex(sockaddr)
+                    if err == 0:
+                        winner = sock
+                        break
+                    if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                        sock.close()
+                        del attempts[sock]
+                        error = OSError(err, os.strerror(err))
+                        continue
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    next_start = now + HAPPY_EYEBALLS_DELAY
+
+                if end is not None and now >= end:
+                    raise deadline.error(connecting=True)
+                timeout = None if end is None else end - now
+                if pending:
+                    timeout = max(0, next_start - now) if timeout is None else max(0, min(timeout, next_start - now))
+                # A selector, as select() fails on descriptors above FD_SETSIZE
+                for key, _ in selector.select(timeout):
+                    sock = key.fileobj
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        winner = sock
+                        break
+                    selector.unregister(sock)
+                    sock.close()
+                    del attempts[sock]
+                    error = OSError(err, os.strerror(err))
+                    next_start = 0
+                if winner is not None:
+                    break
+        finally:
+            selector.close()
+            for sock in attempts:
+                if sock is not winner:
+                    sock.close()
+        if winner is None:
+            raise error
+        winner.setblocking(True)
+        return winner, attempts[winner]
+
+    def connectUnix(self, path, deadline):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(deadline.remaining(deadline.timeout.connect))
+            sock.connect(path)
+        except socket.timeout:
+            sock.close()
+            raise deadline.error(connecting=True) from None
+        except BaseException:
+            sock.close()
+            raise
+        return sock, (path,)
+
+    def connect(self, url_infos, deadline=None, timings=None):
+        # Races the cached addresses of the host, see connectRace, or
+        # connects to url_infos['unix_socket'] when set.
+        # timings: dict receiving the 'dns', 'connect' and 'tls' durations
+        use_ssl = True if url_infos['proto'] == 'https' else False
+        dns = url_infos['dns']
+        if deadline is None:
+            deadline = Deadline(None)
+        if timings is None:
+            timings = {}
+        start = time.perf_counter()
+        if url_infos.get('unix_socket') is not None:
+            sock, sockaddr = self.connectUnix(url_infos['unix_socket'], deadline)
+        else:
+            addrs = self.dns.resolve(dns, url_infos['port'])
+            timings['dns'] = time.perf_counter() - start
+            start = time.perf_counter()
+            sock, sockaddr = self.connectRace(addrs, deadline)
+        timings['connect'] = time.perf_counter() - start
+        if use_ssl:
+            start = time.perf_counter()
+            try:
+                sock.settimeout(deadline.remaining(deadline.timeout.connect))
+                sock = self.wrapTLS(sock, dns, url_infos['port'])
+            except socket.timeout:
+                sock.close()
+                raise deadline.error(connecting=True) from None
+            except BaseException:
+                sock.close()
+                raise
+            timings['tls'] = time.perf_counter() - start
+        url_infos['ip'] = sockaddr[0]
+        return sock
+
+    def sendBody(self, sock, data, chunked):
+        # Regular files of known length go through socket.sendfile, which
+        # uses os.sendfile on plain sockets and falls back to send on TLS
+        if not chunked and hasattr(data, 'fileno') and 'b' in getattr(data, 'mode', 'b'):
+            try:
+                data.fileno()
+                sock.sendfile(data, offset=data.tell(), count=getStreamLength(data))
+                return
+            except OSError:
+                pass
+        for chunk in iterStreamChunks(data):
+            if chunked:
+                sendParts(sock, (b'%x\r\n' % len(chunk), chunk, b'\r\n'))
+            else:
+                sock.sendall(chunk)
+        if chunked:
+            sock.sendall(b'0\r\n\r\n')
+
+    def sendRequest(self, sock, request, data, chunked):
+        # request: head from formatRequest, data: body not included in it
+        if isStreamBody(data):
+            sock.sendall(request)
+            self.sendBody(sock, data, chunked)
+        elif data:
+            sendParts(sock, (request, data))
+        else:
+            sock.sendall(request)
+
+    def addHook(self, func):
+        # func is called with the event dict of every request: 'url', 'host',
+        # 'method', 'repcode', 'timings', 'bytes_in', 'bytes_out', 'reused'
+        # and 'error'
+        self.hooks.append(func)
+
+    def removeHook(self, func):
+        self.hooks.remove(func)
+
+    def emit(self, event):
+        for func in self.hooks:
+            try:
+                func(event)
+            except Exception as e:
+                print("HTTP: Warning: hook error: %s: %s" % (type(e).__name__, e))
+
+    def newEvent(self, url_infos, method):
+        return {'url': getURL(url_infos), 'host': url_infos['dns'], 'method': method, 'repcode': None, 'timings': {}, 'bytes_in': 0, 'bytes_out': 0, 'reused': False, 'cached': False, 'error': None}
+
+    def finishEvent(self, event, sock, start):
+        if sock is not None:
+            event['bytes_in'] = sock.bytes_in
+            event['bytes_out'] = sock.bytes_out
+        event['timings']['total'] = time.perf_counter() - start
+        self.emit(event)
+
+    def _request(self, url_infos, method, keep_alive, timeout, header, data, body_type=bytes, stream=False):
+        # Timings are in seconds: dns, connect, tls (new connections only),
+        # write, ttfb (until the head is read), download, decompress, total.
+        # They are set on the response and sent to the hooks, for streamed
+        # responses once the body has been read.
+        event = self.newEvent(url_infos, method)
+        start = time.perf_counter()
+        try:
+            rep, sock = self._requestOnce(url_infos, method, keep_alive, timeout, header, data, body_type, stream, event)
+        except BaseException as e:
+            event['error'] = e
+            self.finishEvent(event, None, start)
+            raise
+        if rep is None:
+            self.finishEvent(event, sock, start)
+            return None
+        event['repcode'] = rep['repcode']
+        rep['timings'] = event['timings']
+        if stream:
+            rep['stream'].event = event
+            rep['stream'].start = start
+        else:
+            self.finishEvent(event, sock, start)
+        return rep
+
+    def _requestOnce(self, url_infos, method, keep_alive, timeout, header, data, body_type, stream, event):
+        # timeout: Deadline shared by redirects, or a timeout for this request
+        deadline = timeout if isinstance(timeout, Deadline) else Deadline(timeout)
+        timings = event['timings']
+        key = poolKey(url_infos)
+        streamed = isStreamBody(data)
+        chunked = header.get('Transfer-Encoding') == 'chunked'
+        request = self.formatRequest(method, url_infos['path'], header, None)
+
+        # Send HTTP request, first trying an idle pooled connection. A stale
+        # keep-alive socket may fail at any point before the status line is
+        # read, in which case the request is sent again on a fresh socket,
+        # unless it is not idempotent and was written: the server may have
+        # processed it before closing. Streamed bodies that can't be rewound
+        # always use a fresh socket.
+        start_pos = getStreamPosition(data) if streamed else None
+        sock = None
+        if not streamed or start_pos is not None:
+            sock = self.pool.acquire(key)
+        error = True
+        if sock is not None:
+            sock = DeadlineSocket(sock, deadline)
+            event['reused'] = True
+            try:
+                start = time.perf_counter()
+                self.sendRequest(sock, request, data, chunked)
+                timings['write'] = time.perf_counter() - start
+                error, version, repcode, repmsg, headers, body = self.readResponse(sock)
+                timings['ttfb'] = time.perf_counter() - start - timings['write']
+            except HTTPTimeout:
+                self.closeConnection(sock, key)
+                raise
+            except (OSError, ValueError):
+                if sock.bytes_out and method not in idempotent_methods:
+                    self.closeConnection(sock, key)
+                    raise
+                error = True
+            if error:
+                self.closeConnection(sock, key)
+                if sock.bytes_out and method not in idempotent_methods:
+                    return None, sock
+                event['reused'] = False
+                if start_pos is not None:
+                    data.seek(start_pos)
+
+        if error:
+            sock = DeadlineSocket(self.connect(url_infos, deadline, timings), deadline)
+            try:
+                start = time.perf_counter()
+                self.sendRequest(sock, request, data, chunked)
+                timings['write'] = time.perf_counter() - start
+                error, version, repcode, repmsg, headers, body = self.readResponse(sock)
+                timings['ttfb'] = time.perf_counter() - start - timings['write']
+            except BaseException:
+                self.closeConnection(sock, key)
+                raise
+            if error:
+                self.closeConnection(sock, key)
+                return None, sock
+
+        self.keepTLSSession(url_infos, sock)
+        if keep_alive == keep_alive_redirect:
+            keep_alive = isSameOriginRedirect({'repcode': repcode, 'header': headers}, url_infos)
+
+        if stream:
+            body = BodyStream(self, sock, key, headers, body, method, repcode, keep_alive)
+            return {'version': version, 'repcode': repcode, 'repmsg': repmsg, 'header': headers, 'body': None, 'stream': body}, sock
+
+        # Read HTTP response
+        try:
+            start = time.perf_counter()
+            body = self.readBody(sock, headers, body, method, repcode, timings)
+            timings['download'] = time.perf_counter() - start - timings.setdefault('decompress', 0.0)
+        except BaseException:
+            self.closeConnection(sock, key)
+            raise
+        
+        if canKeepAlive(headers, keep_alive, method, repcode):
+            self.pool.release(key, sock)
+        else:
+            self.closeConnection(sock, key)
+        
+        return {'version': version, 'repcode': repcode, 'repmsg': repmsg, 'header': headers, 'body': convertBody(body, body_type)}, sock
+
+
+    def _requestCached(self, url_infos, method, keep_alive, timeout, header, data, body_type=bytes, stream=False):
+        # Goes through self.cache for plain GET requests, conditional and
+        # range requests of the caller are passed through. Fresh hits have
+        # the total timing only and send an event with cached set.
+        cache = self.cache
+        if cache is None or method != 'GET' or data is not None or stream:
+            return self._request(url_infos, method, keep_alive, timeout, header, data, body_type, stream)
+        for name in ('If-None-Match', 'If-Modified-Since', 'Range'):
+            if getRequestHeader(header, name) is not None:
+                return self._request(url_infos, method, keep_alive, timeout, header, data, body_type, stream)
+
+        url = getCacheURL(url_infos)
+        entry = cache.lookup(url, header)
+        if entry is not None:
+            if cache.isFresh(entry, header):
+                event = self.newEvent(url_infos, method)
+                event['cached'] = True
+                start = time.perf_counter()
+                rep = cache.toResponse(entry, body_type)
+                event['repcode'] = rep['repcode']
+                rep['timings'] = event['timings']
+                self.finishEvent(event, None, start)
+                return rep
+            header = cache.addValidators(entry, header)
+
+        rep = self._request(url_infos, method, keep_alive, timeout, header, data, bytes, False)
+        if rep is None:
+            return rep
+        if rep['repcode'] == 304 and entry is not None:
+            timings = rep['timings']
+            rep = cache.toResponse(cache.revalidated(entry, rep), body_type)
+            rep['timings'] = timings
+            return rep
+        cache.store(url, header, rep)
+        rep['body'] = convertBody(rep['body'], body_type)
+        return rep
+
+    def getURLInfos(self, url, unix_socket=None):
+        # parseURL, routed to unix_socket or the Unix socket of this instance
+        url_infos = parseURL(url, resolve=False)
+        if unix_socket is None:
+            unix_socket = self.unix_socket
+        if unix_socket is not None and url_infos['unix_socket'] is None:
+            url_infos['unix_socket'] = unix_socket
+        return url_infos
+
+    def _requestHedged(self, url_infos, method, keep_alive, deadline, header, data, body_type, stream, hedge):
+        delay = None
+        if hedge is not None and method in hedge.methods and data is None:
+            delay = hedge.getDelay(self.stats, url_infos['dns'])
+        if delay is None:
+            return self._requestCached(url_infos, method, keep_alive, deadline, header, data, body_type, stream)
+
+        # Attempts run in their own threads. A losing attempt still completes
+        # in the background so its connection returns to the pool.
+        args = (url_infos, method, keep_alive, deadline, header, data, body_type, stream)
+        futures = [startThread(self._requestCached, *args)]
+        hedges = 0
+        error = None
+        while futures:
+            done, _ = concurrent.futures.wait(futures, delay if hedges < hedge.max_hedges else None, concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                hedges += 1
+                futures.append(startThread(self._requestCached, *args))
+                continue
+            for future in done:
+                futures.remove(future)
+                if future.exception() is not None:
+                    error = future.exception()
+                elif future.result() is not None:
+                    for other in futures:
+                        other.add_done_callback(discardResponse)
+                    return future.result()
+        if error is not None:
+            raise error
+        return None
+
+    def _requestFollow(self, url_infos, method, keep_alive, deadline, follow_redirect, header, data, start_pos, body_type, stream, hedge):
+        if not follow_redirect:
+            return self._requestHedged(url_infos, method, keep_alive, deadline, header, data, body_type, stream, hedge)
+
+        # Same origin hops reuse the pooled connection of the previous one,
+        # whose body has been read entirely, even without keep-alive
+        if not keep_alive:
+            keep_alive = keep_alive_redirect
+            header = Headers(header)
+            header['Connection'] = 'keep-alive'
+        rep = self._requestHedged(url_infos, method, keep_alive, deadline, header, data, body_type, stream, hedge)
+        for _ in range(REDIRECT_MAX_HOPS):
+            hop = prepareRedirect(rep, url_infos, method, header, data)
+            if hop is None:
+                break
+            if rep['repcode'] in permanent_redirect_codes and self.redirects is not None:
+                self.redirects.store(getURL(url_infos), rep, url_infos['unix_socket'])
+            if stream:
+                for _ in rep['stream']: pass
+            url_infos, method, header, data = hop
+            
+            #print("Redirect to: "+getURL(url_infos))
+            if start_pos is not None and data is not None:
+                data.seek(start_pos)
+            rep = self._requestHedged(url_infos, method, keep_alive, deadline, header, data, body_type, stream, hedge)
+        return rep
+
+    def _requestRetried(self, url_infos, method, keep_alive, deadline, follow_redirect, header, data, body_type, stream, retry, hedge):
+        start_pos = getStreamPosition(data) if isStreamBody(data) else None
+        rewindable = start_pos is not None or not isStreamBody(data)
+
+        if retry is not None and retry.budget is not None:
+            retry.budget.deposit()
+        attempt = 0
+        while 1:
+            error = None
+            try:
+                rep = self._requestFollow(url_infos, method, keep_alive, deadline, follow_redirect, header, data, start_pos, body_type, stream, hedge)
+            except Exception as e:
+                if retry is None or not retry.isRetryable(method, error=e):
+                    raise
+                rep, error = None, e
+            else:
+                if retry is None or not retry.isRetryable(method, rep):
+                    return rep
+
+            delay = retry.getDelay(attempt, rep)
+            if attempt >= retry.total or not rewindable or (deadline.end is not None and time.monotonic() + delay >= deadline.end) or (retry.budget is not None and not retry.budget.withdraw()):
+                if error is not None:
+                    raise error
+                return rep
+            if rep is not None and stream:
+                rep['stream'].close()
+            time.sleep(delay)
+            attempt += 1
+            if start_pos is not None:
+                data.seek(start_pos)
+
+    def request(self, url, method="GET", keep_alive=None, timeout=6, follow_redirect=True, header=None, data=None, body_type=bytes, stream=False, retry=None, hedge=None, coalesce=None, unix_socket=None):
+        # stream: return once the head is read, the body is then iterated
+        # from rep['stream'] (see BodyStream)
+        # timeout: seconds for connect and each read, or a Timeout
+        # retry, hedge: Retry and Hedge policies, None for the defaults of
+        # this instance and False for none
+        # coalesce: identical GET and HEAD requests issued while one is in
+        # progress wait for its response instead of going to the network,
+        # None for the default of this instance
+        # unix_socket: path of a Unix socket to send the request to, like
+        # http+unix:// urls
+        method = method.upper()
+
+        if keep_alive is None:
+            keep_alive = self.defaultkeepalive
+        retry = self.retry if retry is None else retry or None
+        hedge = self.hedge if hedge is None else hedge or None
+        if coalesce is None:
+            coalesce = self.coalesce
+        
+        deadline = Deadline(timeout)
+        url_infos = self.getURLInfos(url, unix_socket)
+        if follow_redirect and self.redirects is not None:
+            url, unix_socket, hops = self.redirects.resolve(getURL(url_infos), method, url_infos['unix_socket'])
+            if hops:
+                url_infos = parseURL(url, resolve=False)
+                url_infos['unix_socket'] = unix_socket
+        header, data = prepareRequest(url_infos, method, keep_alive, header, data)
+        args = (url_infos, method, keep_alive, deadline, follow_redirect, header, data, body_type, stream, retry, hedge)
+        if not coalesce or method not in ('GET', 'HEAD') or data is not None:
+            return self._requestRetried(*args)
+
+        key = (method, getURL(url_infos), url_infos['unix_socket'], tuple(sorted((k.lower(), str(v)) for k, v in header.items())), follow_redirect, body_type, stream)
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                flight.followers += 1
+        if not leader:
+            # Followers wait for the response within their own total timeout,
+            # the read timeout only bounds each wait of the leader on its
+            # socket
+            done, _ = concurrent.futures.wait([flight.future], deadline.remaining(None))
+            if not done:
+                self.leaveFlight(key, flight)
+                raise deadline.error()
+            return shareResponse(flight.future.result())
+
+        try:
+            rep = self._requestRetried(*args)
+        except BaseException as e:
+            with self.flights_lock:
+                del self.flights[key]
+            flight.future.set_exception(e)
+            raise
+        with self.flights_lock:
+            del self.flights[key]
+            followers = flight.followers
+        if not followers:
+            flight.future.set_result(rep)
+            return rep
+        if rep is not None and stream:
+            rep['stream'] = SharedStream(rep['stream'], followers + 1)
+        flight.future.set_result(rep)
+        return shareResponse(rep)
+
+    def leaveFlight(self, key, flight):
+        # A follower that timed out is no longer counted, or once the
+        # leader is done, releases its share of the response
+        with self.flights_lock:
+            if self.flights.get(key) is flight:
+                flight.followers -= 1
+                return
+        flight.future.add_done_callback(releaseShare)
+
+
+    def _requestManyIter(self, requests, max_workers, per_host):
+        # Requests are queued per origin and only handed to the thread pool
+        # while their origin is under per_host, so a slow host cannot hold
+        # every worker while requests for other hosts wait.
+        pending = {}  # key -> list of (index, spec), in submit order
+        order = []    # keys with pending requests, round robin
+        active = {}   # key -> running count
+        running = {}  # future -> (index, key)
+        errors = []
+
+        for index, spec in enumerate(requests):
+            if isinstance(spec, str):
+                spec = {'url': spec}
+            try:
+                key = poolKey(parseURL(spec['url'], resolve=False))
+            except Exception as e:
+                errors.append({'index': index, 'response': None, 'error': e})
+                continue
+            if key not in pending:
+                pending[key] = []
+                order.append(key)
+            pending[key].append((index, spec))
+
+        for item in errors:
+            yield item
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                while order or running:
+                    i = 0
+                    while i < len(order) and len(running) < max_workers:
+                        key = order[i]
+                        if active.get(key, 0) >= per_host:
+                            i += 1
+                            continue
+                        index, spec = pending[key].pop(0)
+                        if not pending[key]:
+                            del pending[key]
+                            order.pop(i)
+                        else:
+                            i += 1
+                        active[key] = active.get(key, 0) + 1
+                        running[executor.submit(self.request, **spec)] = (index, key)
+
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        index, key = running.pop(future)
+                        active[key] -= 1
+                        error = future.exception()
+                        yield {'index': index, 'response': None if error else future.result(), 'error': error}
+            finally:
+                for future in running:
+                    future.cancel()
+
+    def _requestPipelinedOnce(self, url_infos, method, requests, reused, deadline):
+        # Sends every request back to back on one connection then reads the
+        # responses in order. Returns the responses read before the server
+        # closed the connection or asked to close it.
+        key = poolKey(url_infos)
+        sock = self.pool.acquire(key) if reused else self.connect(url_infos, deadline)
+        if sock is None:
+            return None
+        sock = DeadlineSocket(sock, deadline)
+        reps = []
+        rest = b''
+        reusable = False
+        try:
+            sock.sendall( b''.join(requests) )
+            while len(reps) < len(requests):
+                error, version, repcode, repmsg, headers, body = self.readResponse(sock, rest)
+                if error: break
+                body, rest = self.readBodyFramed(sock, headers, body, method, repcode)
+                reps.append({'version': version, 'repcode': repcode, 'repmsg': repmsg, 'header': headers, 'body': bytes(body)})
+                reusable = canKeepAlive(headers, True, method, repcode)
+                if not reusable: break
+        except HTTPTimeout:
+            self.closeConnection(sock, key)
+            raise
+        except (OSError, ValueError):
+            reusable = False
+
+        if reps:
+            self.keepTLSSession(url_infos, sock)
+        if reusable and len(reps) == len(requests) and not rest:
+            self.pool.release(key, sock)
+        else:
+            self.closeConnection(sock, key)
+        return reps
+
+    def requestPipelined(self, urls, method="GET", keep_alive=None, timeout=6, follow_redirect=True, header=None):
+        # HTTP/1.1 pipelining of idempotent requests to a single origin.
+        # When the server closes the connection mid-pipeline the remaining
+        # requests are pipelined again on a new connection, and sent one by
+        # one if a fresh connection makes no progress.
+        method = method.upper()
+        if method not in ("GET", "HEAD"):
+            raise ValueError("HTTP: pipelining is only allowed for GET and HEAD requests")
+
+        if keep_alive is None:
+            keep_alive = self.defaultkeepalive
+
+        infos = [self.getURLInfos(url) for url in urls]
+        if not infos:
+            return []
+        key = poolKey(infos[0])
+        for url_infos in infos:
+            if poolKey(url_infos) != key:
+                raise ValueError("HTTP: pipelined requests must share the same origin")
+        url_infos = infos[0]
+
+        requests = []
+        for info in infos:
+            hdr, _ = prepareRequest(info, method, True, header, None)
+            requests.append( self.formatRequest(method, info['path'], hdr, None) )
+
+        deadline = Deadline(timeout)
+        reps = []
+        reused = True
+        while len(reps) < len(requests):
+            got = self._requestPipelinedOnce(url_infos, method, requests[len(reps):], reused, deadline)
+            if got is None:
+                reused = False
+                continue
+            if not got and not reused:
+                break
+            reps += got
+            reused = False
+
+        # Fallback to sequential requests
+        for url in urls[len(reps):]:
+            reps.append( self.request(url, method, True, deadline.timeout, False, header) )
+
+        if not keep_alive:
+            self.pool.clear(key)
+
+        if follow_redirect:
+            for i, info in enumerate(infos):
+                loc = getRedirectLocation(reps[i], getURL(info))
+                if loc is not None:
+                    reps[i] = self.request(loc, method, keep_alive, timeout, True, header)
+        return reps
+
+    def requestMany(self, requests, max_workers=8, per_host=4, ordered=True):
+        # requests: list of urls or dicts of request() arguments.
+        # Each result is {'index', 'response', 'error'}. When ordered the
+        # results are returned as a list in input order, otherwise they are
+        # yielded as they complete.
+        results = self._requestManyIter(requests, max_workers, per_host)
+        if not ordered:
+            return results
+        out = [None] * len(requests)
+        for item in results:
+            out[item['index']] = item
+        return out
+
+    def download(self, url, path, segments=4, timeout=6, header=None, retry=None, min_segment_size=DOWNLOAD_MIN_SEGMENT_SIZE):
+        # Downloads url to path in parallel Range requests of up to segments
+        # pooled connections, written in place with os.pwrite. Progress is
+        # kept in path + '.download', so an interrupted download of the same
+        # unchanged resource resumes where it stopped. Servers without range
+        # support are read in a single stream.
+        # Returns {'path', 'size', 'segments', 'resumed'}.
+        header = dict(header or {})
+        header['Accept-Encoding'] = 'identity'
+        probe = dict(header, Range='bytes=0-0')
+        rep = self.request(url, 'GET', True, timeout, True, probe, stream=True, retry=retry)
+        if rep is None:
+            raise ConnectionError("HTTP: Incomplete response from %s" % url)
+
+        if rep['repcode'] == 200:
+            with rep['stream'] as stream, open(path, 'wb') as f:
+                size = 0
+                for chunk in stream:
+                    f.write(chunk)
+                    size += len(chunk)
+            return {'path': path, 'size': size, 'segments': 1, 'resumed': 0}
+        rep['stream'].close()
+        content_range = getHeader(rep['header'], 'content-range') or ''
+        if rep['repcode'] not in (206, 416) or '/' not in content_range or not content_range.rpartition('/')[2].strip().isdigit():
+            raise ValueError("HTTP: Can't download %s, status %s" % (url, rep['repcode']))
+        size = int(content_range.rpartition('/')[2])
+        validator = getHeader(rep['header'], 'etag') or getHeader(rep['header'], 'last-modified')
+
+        # Resume state, segments as [start, end, bytes done]
+        state_path = path + '.download'
+        state = None
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            if state['url'] != url or state['size'] != size or state['validator'] != validator or validator is None or not os.path.exists(path):
+                state = None
+        except (OSError, ValueError, KeyError):
+            state = None
+        if state is None:
+            count = max(1, min(segments, -(-size // min_segment_size)))
+            bounds = [size * i // count for i in range(count + 1)]
+            state = {'url': url, 'size': size, 'validator': validator, 'segments': [[bounds[i], bounds[i+1] - 1, 0] for i in range(count)]}
+        resumed = sum(seg[2] for seg in state['segments'])
+
+        lock = threading.Lock()
+        saved = [time.monotonic()]
+        def saveState(force=False):
+            with lock:
+                if not force and time.monotonic() - saved[0] < DOWNLOAD_STATE_INTERVAL:
+                    return
+                saved[0] = time.monotonic()
+                data = json.dumps(state)
+            with open(state_path + '.tmp', 'w') as f:
+                f.write(data)
+            os.replace(state_path + '.tmp', state_path)
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+                if hasattr(os, 'posix_fallocate') and size:
+                    try:
+                        os.posix_fallocate(fd, 0, size)
+                    except OSError:
+                        pass
+            saveState(True)
+
+            def fetch(seg):
+                start, end = seg[0] + seg[2], seg[1]
+                if start > end:
+                    return
+                rheader = dict(header, Range='bytes=%d-%d' % (start, end))
+                if validator is not None:
+                    rheader['If-Range'] = validator
+                rep = self.request(url, 'GET', True, timeout, True, rheader, stream=True, retry=retry)
+                if rep is None:
+                    raise ConnectionError("HTTP: Incomplete response from %s" % url)
+                with rep['stream'] as stream:
+                    if rep['repcode'] != 206 or not (getHeader(rep['header'], 'content-range') or '').startswith('bytes %d-' % start):
+                        raise ValueError("HTTP: %s changed during the download, status %s" % (url, rep['repcode']))
+                    offset = start
+                    for chunk in stream:
+                        chunk = memoryview(chunk)[:end + 1 - offset]
+                        while chunk:
+                            n = os.pwrite(fd, chunk, offset)
+                            offset += n
+                            chunk = chunk[n:]
+                            with lock:
+                                seg[2] += n
+                        saveState()
+                        if offset > end:
+                            break
+                if offset <= end:
+                    raise ConnectionError("HTTP: Incomplete range from %s" % url)
+
+            futures = [startThread(fetch, seg) for seg in state['segments']]
+            errors = [f.exception() for f in futures if f.exception() is not None]
+            if errors:
+                saveState(True)
+                raise errors[0]
+        finally:
+            os.close(fd)
+        os.remove(state_path)
+        return {'path': path, 'size': size, 'segments': len(state['segments']), 'resumed': resumed}
+
+    def websocket(self, url, header=None, timeout=6, subprotocols=None, compress=True, max_size=WS_MAX_MESSAGE_SIZE, fragment_size=None):
+        # Opens a WebSocket connection to a ws:// or wss:// url.
+        # timeout: seconds for the handshake, or a Timeout
+        # compress: offer permessage-deflate
+        # fragment_size: split sent messages into frames of at most this size
+        deadline = Deadline(timeout)
+        url_infos, header, key = prepareWebSocket(url, header, subprotocols, compress, self.unix_socket)
+        sock = DeadlineSocket(self.connect(url_infos, deadline), deadline)
+        try:
+            self.sendRequest(sock, self.formatRequest('GET', url_infos['path'], header, None), None, False)
+            error, version, repcode, repmsg, headers, data = self.readResponse(sock)
+            if error:
+                raise WebSocketError("WebSocket: Incomplete handshake response")
+            deflate, subprotocol = checkWebSocket(repcode, headers, key, subprotocols)
+        except BaseException:
+            sock.close()
+            raise
+        sock = sock.sock
+        sock.settimeout(None)
+        return WebSocket(sock, WebSocketProtocol(deflate, max_size, fragment_size), bytes(data), subprotocol, headers)
+
+
+# Asyncio HTTP class
+class AsyncHTTP():
+    formatRequest = HTTP.formatRequest
+    getURLInfos = HTTP.getURLInfos
+
+    def __init__(self, keep_alive=False, pool_maxsize=POOL_MAXSIZE_PER_HOST, pool_idle_timeout=POOL_IDLE_TIMEOUT, dns=None, tls=None, unix_socket=None):
+        self.defaultkeepalive = keep_alive
+        self.unix_socket = unix_socket
+        self.dns = dns_cache if dns is None else dns
+        self.tls = TLSConfig() if tls is None else tls
+        self.tls_origins = {}  # (host, port) -> TLSConfig
+        self.pool_maxsize = pool_maxsize
+        self.pool_idle_timeout = pool_idle_timeout
+        self.idle = {}  # key -> list of (reader, writer, release time)
+
+    def acquire(self, key):
+        now = time.monotonic()
+        conns = self.idle.get(key)
+        while conns:
+            reader, writer, released = conns.pop()
+            expired = self.pool_idle_timeout is not None and now - released > self.pool_idle_timeout
+            if expired or reader.at_eof() or writer.is_closing():
+                writer.close()
+                continue
+            return reader, writer
+        return None
+
+    def release(self, key, reader, writer):
+        conns = self.idle.setdefault(key, [])
+        if len(conns) < self.pool_maxsize:
+            conns.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    async def closeAllConnection(self):
+        conns = [c for l in self.idle.values() for c in l]
+        self.idle = {}
+        for _, writer, _ in conns:
+            writer.close()
+        for _, writer, _ in conns:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    def setOriginTLS(self, host, config, port=443):
+        self.tls_origins[(host, port)] = config
+
+    async def wait(self, aw, deadline, connecting=False):
+        limit = deadline.timeout.connect if connecting else deadline.timeout.read
+        try:
+            timeout = deadline.remaining(limit)
+        except HTTPTimeout:
+            aw.close()
+            raise
+        try:
+            return await asyncio.wait_for(aw, timeout)
+        except asyncio.TimeoutError:
+            raise deadline.error(connecting) from None
+
+    async def connectRace(self, addrs):
+        # Happy eyeballs, as HTTP.connectRace
+        loop = asyncio.get_running_loop()
+        pending = collections.deque(interleaveAddresses(addrs))
+        attempts = {}  # task -> (sock, sockaddr)
+        winner = None
+        error = None
+        try:
+            while pending or attempts:
+                if pending:
+                    family, sockaddr = pending.popleft()
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    sock.setblocking(False)
+                    attempts[loop.create_task(loop.sock_connect(sock, sockaddr))] = (sock, sockaddr)
+                done, _ = await asyncio.wait(attempts, timeout=HAPPY_EYEBALLS_DELAY if pending else None, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    sock, sockaddr = attempts.pop(task)
+                    if task.exception() is None:
+                        winner = (sock, sockaddr)
+                        break
+                    sock.close()
+                    error = task.exception()
+                if winner is not None:
+                    return winner
+            raise error
+        finally:
+            for task, (sock, sockaddr) in attempts.items():
+                task.cancel()
+                sock.close()
+
+    async def connect(self, url_infos, deadline):
+        dns, port = url_infos['dns'], url_infos['port']
+        use_ssl = self.tls_origins.get((dns, port), self.tls).context if url_infos['proto'] == 'https' else None
+        if url_infos.get('unix_socket') is not None:
+            conn = await self.wait(asyncio.open_unix_connection(url_infos['unix_socket'], ssl=use_ssl, server_hostname=dns if use_ssl else None), deadline, True)
+            url_infos['ip'] = url_infos['unix_socket']
+            return conn
+        addrs = self.dns.get(dns, port)
+        if addrs is None:
+            addrs = await asyncio.get_running_loop().run_in_executor(None, self.dns.lookup, dns, port)
+        sock, sockaddr = await self.wait(self.connectRace(addrs), deadline, True)
+        try:
+            conn = await self.wait(asyncio.open_connection(sock=sock, ssl=use_ssl, server_hostname=dns if use_ssl else None), deadline, True)
+        except BaseException:
+            sock.close()
+            raise
+        url_infos['ip'] = sockaddr[0]
+        return conn
+
+
+    async def readResponse(self, reader, deadline):
+        try:
+            data = await self.wait(reader.readuntil(b'\r\n\r\n'), deadline)
+        except asyncio.IncompleteReadError:
+            return True, None, None, None, None
+        step, version, repcode, repmsg, key, val, headers = HTTP_STEP_REPVER, bytearray(), bytearray(), bytearray(), bytearray(), bytearray(), Headers()
+        i, step, version, repcode, repmsg, key, val, headers, complet = parseRepHeader(data, 0, len(data), step, version, repcode, repmsg, key, val, headers)
+        if not complet:
+            return True, None, None, None, None
+        return False, bytesDecode(version), int(repcode), bytesDecode(repmsg), headers
+
+    async def readBody(self, reader, headers, deadline, method=None, repcode=None):
+        if hasNoBody(method, repcode):
+            return bytearray()
+
+        # Read all body
+        body = bytearray()
+        if getHeader(headers, 'transfer-encoding') == 'chunked':
+            while 1:
+                line = await self.wait(reader.readuntil(b'\r\n'), deadline)
+                chunk_len = int(line.split(b';', 1)[0], 16)
+                if chunk_len == 0:
+                    # Skip trailers
+                    while await self.wait(reader.readuntil(b'\r\n'), deadline) != b'\r\n':
+                        pass
+                    break
+                body += await self.wait(reader.readexactly(chunk_len), deadline)
+                await self.wait(reader.readexactly(2), deadline)
+        else:
+            remaining = int( getHeader(headers, 'content-length') ) if hasHeader(headers, 'content-length') else -1
+            while remaining:
+                data = await self.wait(reader.read(UPLOAD_CHUNK_SIZE if remaining < 0 else min(remaining, UPLOAD_CHUNK_SIZE)), deadline)
+                if not data:
+                    if remaining > 0: raise asyncio.IncompleteReadError(bytes(body), len(body) + remaining)
+                    break
+                body += data
+                if remaining > 0: remaining -= len(data)
+        
+        return decodeBody(headers, body)
+
+    async def sendRequest(self, writer, request, data, chunked, deadline):
+        writer.write( request )
+        if data and not isStreamBody(data):
+            writer.write(data)
+        elif isStreamBody(data):
+            for chunk in iterStreamChunks(data):
+                if chunked:
+                    writer.write(b'%x\r\n' % len(chunk))
+                    writer.write(chunk)
+                    writer.write(b'\r\n')
+                else:
+                    writer.write(chunk)
+                await self.wait(writer.drain(), deadline)
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+        await self.wait(writer.drain(), deadline)
+
+    async def _request(self, url_infos, method, keep_alive, deadline, header, data, body_type=bytes):
+        key = poolKey(url_infos)
+        streamed = isStreamBody(data)
+        chunked = header.get('Transfer-Encoding') == 'chunked'
+        request = self.formatRequest(method, url_infos['path'], header, None)
+
+        # Send HTTP request, see HTTP._request for the stale connection retry
+        start_pos = getStreamPosition(data) if streamed else None
+        conn = None
+        if not streamed or start_pos is not None:
+            conn = self.acquire(key)
+        error = True
+        if conn is not None:
+            reader, writer = conn
+            sent = False
+            try:
+                await self.sendRequest(writer, request, data, chunked, deadline)
+                sent = True
+                error, version, repcode, repmsg, headers = await self.readResponse(reader, deadline)
+            except HTTPTimeout:
+                writer.close()
+                raise
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                if sent and method not in idempotent_methods:
+                    writer.close()
+                    raise
+                error = True
+            if error:
+                writer.close()
+                if sent and method not in idempotent_methods:
+                    return None
+                if start_pos is not None:
+                    data.seek(start_pos)
+
+        if error:
+            reader, writer = await self.connect(url_infos, deadline)
+            try:
+                await self.sendRequest(writer, request, data, chunked, deadline)
+                error, version, repcode, repmsg, headers = await self.readResponse(reader, deadline)
+            except BaseException:
+                writer.close()
+                raise
+            if error:
+                writer.close()
+                return None
+
+        if keep_alive == keep_alive_redirect:
+            keep_alive = isSameOriginRedirect({'repcode': repcode, 'header': headers}, url_infos)
+
+        # Read HTTP response
+        try:
+            body = await self.readBody(reader, headers, deadline, method, repcode)
+        except BaseException:
+            writer.close()
+            raise
+
+        if canKeepAlive(headers, keep_alive, method, repcode):
+            self.release(key, reader, writer)
+        else:
+            writer.close()
+
+        return {'version': version, 'repcode': repcode, 'repmsg': repmsg, 'header': headers, 'body': convertBody(body, body_type)}
+
+    async def request(self, url, method="GET", keep_alive=None, timeout=6, follow_redirect=True, header=None, data=None, body_type=bytes, unix_socket=None):
+        method = method.upper()
+
+        if keep_alive is None:
+            keep_alive = self.defaultkeepalive
+
+        deadline = Deadline(timeout)
+        url_infos = self.getURLInfos(url, unix_socket)
+        header, data = prepareRequest(url_infos, method, keep_alive, header, data)
+        if follow_redirect and not keep_alive:
+            # See HTTP._requestFollow
+            keep_alive = keep_alive_redirect
+            header['Connection'] = 'keep-alive'
+
+        rep = await self._request(url_infos, method, keep_alive, deadline, header, data, body_type)
+
+        if follow_redirect:
+            for _ in range(REDIRECT_MAX_HOPS):
+                hop = prepareRedirect(rep, url_infos, method, header, data)
+                if hop is None:
+                    break
+                url_infos, method, header, data = hop
+                rep = await self._request(url_infos, method, keep_alive, deadline, header, data, body_type)
+        return rep
+
+    async def websocket(self, url, header=None, timeout=6, subprotocols=None, compress=True, max_size=WS_MAX_MESSAGE_SIZE, fragment_size=None):
+        # See HTTP.websocket
+        deadline = Deadline(timeout)
+        url_infos, header, key = prepareWebSocket(url, header, subprotocols, compress, self.unix_socket)
+        reader, writer = await self.connect(url_infos, deadline)
+        try:
+            writer.write(self.formatRequest('GET', url_infos['path'], header, None))
+            await self.wait(writer.drain(), deadline)
+            error, version, repcode, repmsg, headers = await self.readResponse(reader, deadline)
+            if error:
+                raise WebSocketError("WebSocket: Incomplete handshake response")
+            deflate, subprotocol = checkWebSocket(repcode, headers, key, subprotocols)
+        except BaseException:
+            writer.close()
+            raise
+        return AsyncWebSocket(reader, writer, WebSocketProtocol(deflate, max_size, fragment_size), subprotocol, headers)
+
+
+
+# File part of a server response
+class FileBody():
+    # count bytes of the file at path from offset, sent with os.sendfile so
+    # the data never goes through user space. The file is opened on the
+    # first send.
+    def __init__(self, path, offset=0, count=None):
+        self.path = path
+        self.offset = offset
+        self.remaining = os.stat(path).st_size - offset if count is None else count
+        self.fd = None
+
+    def __len__(self):
+        return self.remaining
+
+    def sendTo(self, sock):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        if hasattr(os, 'sendfile'):
+            n = os.sendfile(sock.fileno(), self.fd, self.offset, min(self.remaining, 0x7ffff000))
+        else:
+            n = sock.send(os.pread(self.fd, min(self.remaining, UPLOAD_CHUNK_SIZE), self.offset))
+        self.offset += n
+        self.remaining -= n
+        return n
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# Server connection state
+class ServerConnection():
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = bytearray()
+        self.out = collections.deque()  # bytes to send, or iterators of body chunks
+        self.events = selectors.EVENT_READ
+        self.close_after = False
+        self.closed = False
+        self.resetParser()
+
+    def resetParser(self):
+        self.step = HTTP_STEP_METHOD
+        self.i = 0
+        self.method = b''
+        self.path = b''
+        self.version = b''
+        self.headers = Headers()
+        self.head_complete = False
+        self.continue_sent = False
+
+
+def listenUnix(path, backlog=128):
+    # Listening Unix domain socket at path, replacing a stale socket file
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        sock.listen(backlog)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+# Non-blocking HTTP/1.1 server
+class HTTPServer():
+    # Serves every connection from one thread with a selector. handler is
+    # called with a request dict ('method', 'path', 'version', 'header',
+    # 'body', 'addr') and returns a response dict ('repcode', 'repmsg',
+    # 'header', 'body'). The body may be str, bytes, a FileBody, a list of
+    # those, or any other iterable which is sent with chunked transfer
+    # encoding.
+    formatResponse = HTTP.formatResponse
+
+    def __init__(self, handler, host='', port=8080, backlog=128, sock=None, max_body_size=SERVER_MAX_BODY_SIZE, unix_socket=None):
+        # unix_socket: path to listen on instead of host and port
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.sock = sock
+        self.unix_socket = unix_socket
+        self.max_body_size = max_body_size
+        self.selector = None
+        self.connections = {}
+        self.running = False
+
+    def listen(self):
+        if self.sock is None and self.unix_socket is not None:
+            self.sock = listenUnix(self.unix_socket, self.backlog)
+        elif self.sock is None:
+            self.sock = socket.create_server((self.host, self.port), backlog=self.backlog)
+        self.sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+
+    def serveForever(self, poll_interval=0.5):
+        if self.selector is None:
+            self.listen()
+        self.running = True
+        while self.running:
+            for key, events in self.selector.select(poll_interval):
+                if key.data is None:
+                    self.accept()
+                    continue
+                conn = key.data
+                if events & selectors.EVENT_READ:
+                    self.onReadable(conn)
+                if events & selectors.EVENT_WRITE and not conn.closed:
+                    self.flush(conn)
+
+    def stop(self):
+        self.running = False
+
+    def shutdown(self, timeout=5):
+        # Stops accepting, sends the queued responses then closes
+        self.running = False
+        if self.selector is None:
+            return
+        if self.sock is not None:
+            self.selector.unregister(self.sock)
+            self.closeListener()
+        for conn in list(self.connections.values()):
+            conn.close_after = True
+            if conn.out: self.setEvents(conn)
+            else: self.closeConnection(conn)
+        end = time.monotonic() + timeout
+        while self.connections and time.monotonic() < end:
+            for key, events in self.selector.select(min(0.1, max(end - time.monotonic(), 0))):
+                if events & selectors.EVENT_WRITE and not key.data.closed:
+                    self.flush(key.data)
+        self.close()
+
+    def closeListener(self):
+        self.sock.close()
+        self.sock = None
+        if self.unix_socket is not None:
+            try:
+                os.unlink(self.unix_socket)
+            except OSError:
+                pass
+
+    def close(self):
+        self.running = False
+        for conn in list(self.connections.values()):
+            self.closeConnection(conn)
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        if self.sock is not None:
+            self.closeListener()
+
+
+    def accept(self):
+        while 1:
+            try:
+                sock, addr = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print("HTTP: Warning: accept failed: " + str(e))
+                return
+            sock.setblocking(False)
+            if sock.family in (socket.AF_INET, socket.AF_INET6):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = ServerConnection(sock, addr)
+            self.connections[sock.fileno()] = conn
+            self.selector.register(sock, conn.events, conn)
+
+    def closeConnection(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        for item in conn.out:
+            if hasattr(item, 'close'):
+                item.close()
+        conn.out.clear()
+        self.connections.pop(conn.sock.fileno(), None)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+    def setEvents(self, conn):
+        events = selectors.EVENT_WRITE if conn.out else 0
+        if not conn.close_after:
+            events |= selectors.EVENT_READ
+        if events != conn.events:
+            conn.events = events
+            self.selector.modify(conn.sock, events, conn)
+
+    def onReadable(self, conn):
+        while 1:
+            try:
+                data = conn.sock.recv(UPLOAD_CHUNK_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.closeConnection(conn)
+                return
+            if not data:
+                # Peer closed its side, finish sending what is queued
+                conn.close_after = True
+                break
+            conn.inbuf += data
+        if not conn.close_after or conn.inbuf:
+            self.processInput(conn)
+        self.flush(conn)
+
+
+    def parseBody(self, conn):
+        # Returns the request body and the position following it, or None,
+        # None when more data is needed
+        start = conn.i
+        codings = ','.join(conn.headers.getAll('Transfer-Encoding'))
+        if codings:
+            # The body is only delimited when the last coding is chunked,
+            # anything else is rejected so it can't be read as a request
+            if codings.rpartition(',')[2].strip().lower() != 'chunked':
+                raise ValueError()
+            body, end = parseChunkedBody(conn.inbuf, start)
+            if body is None and len(conn.inbuf) - start > self.max_body_size:
+                raise OverflowError()
+            return body, end
+        length = int( getHeader(conn.headers, 'content-length') or 0 )
+        if length < 0:
+            raise ValueError()
+        if length > self.max_body_size:
+            raise OverflowError()
+        if len(conn.inbuf) - start < length:
+            return None, None
+        return bytes(conn.inbuf[start:start+length]), start + length
+
+    def processInput(self, conn):
+        # Handles every complete request of the input buffer, in order, so
+        # pipelined requests are answered in sequence
+        while not conn.close_after or conn.inbuf:
+            try:
+                if not conn.head_complete:
+                    conn.i, conn.step, conn.method, conn.path, conn.version, _, _, conn.headers, complete = parseReqHeader(conn.inbuf, conn.i, len(conn.inbuf), conn.step, conn.method, conn.path, conn.version, b'', b'', conn.headers)
+                    if not complete:
+                        if len(conn.inbuf) > SERVER_MAX_HEADER_SIZE:
+                            self.sendError(conn, 431)
+                        elif conn.close_after:
+                            conn.inbuf.clear()
+                        return
+                    # Request line of method, path and version
+                    if not conn.method or not conn.path or not conn.version:
+                        raise ValueError()
+                    conn.head_complete = True
+                body, end = self.parseBody(conn)
+            except OverflowError:
+                self.sendError(conn, 413)
+                return
+            except ValueError:
+                self.sendError(conn, 400)
+                return
+
+            if body is None:
+                if conn.close_after:
+                    conn.inbuf.clear()
+                elif not conn.continue_sent and getHeader(conn.headers, 'expect') == '100-continue':
+                    conn.continue_sent = True
+                    conn.out.append(b'HTTP/1.1 100 Continue\r\n\r\n')
+                return
+
+            request = {'method': bytesDecode(conn.method), 'path': bytesDecode(conn.path), 'version': bytesDecode(conn.version), 'header': conn.headers, 'body': body, 'addr': conn.addr}
+            del conn.inbuf[:end]
+            conn.resetParser()
+            self.respond(conn, request)
+            if conn.close_after:
+                conn.inbuf.clear()
+                return
+
+    def sendError(self, conn, code):
+        self.queueResponse(conn, None, {'repcode': code}, False)
+        conn.close_after = True
+        conn.inbuf.clear()
+
+    def respond(self, conn, request):
+        version = request['version'].upper()
+        connection = (getHeader(request['header'], 'connection') or '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+        try:
+            rep = self.handler(request)
+        except Exception as e:
+            print("HTTP: Warning: handler error: %s: %s" % (type(e).__name__, e))
+            rep = {'repcode': 500}
+        if rep is None:
+            rep = {'repcode': 404}
+        self.queueResponse(conn, request, rep, keep_alive)
+        if not keep_alive:
+            conn.close_after = True
+
+    def queueResponse(self, conn, request, rep, keep_alive):
+        code = rep.get('repcode', 200)
+        msg = rep.get('repmsg')
+        if msg is None:
+            try:
+                msg = http.HTTPStatus(code).phrase
+            except ValueError:
+                msg = ''
+        header = dict(rep.get('header') or {})
+        body = rep.get('body')
+        if isinstance(body, (str, FileBody)):
+            body = [body]
+        if isinstance(body, list):
+            body = [part.encode('utf8') if isinstance(part, str) else part for part in body]
+
+        streamed = body is not None and not isinstance(body, (bytes, bytearray, memoryview, list))
+        if hasNoBody(None, code):
+            # 1xx and 204 responses must not have a Content-Length, and that
+            # of a 304 can only be the size of the full representation, so
+            # it is left to the handler
+            if code != 304:
+                header.pop('Content-Length', None)
+        elif streamed:
+            header['Transfer-Encoding'] = 'chunked'
+        elif 'Content-Length' not in header:
+            length = 0 if body is None else sum(len(part) for part in body) if isinstance(body, list) else len(body)
+            header['Content-Length'] = str(length)
+        header['Connection'] = 'keep-alive' if keep_alive else 'close'
+
+        conn.out.append( self.formatResponse(code, msg, header, None) )
+        if hasNoBody(None if request is None else request['method'], code):
+            if streamed and hasattr(body, 'close'):
+                body.close()
+        elif streamed:
+            conn.out.append( iter(body) )
+        elif isinstance(body, list):
+            conn.out.extend( part for part in body if len(part) )
+        elif body:
+            conn.out.append( body )
+
+    def flush(self, conn):
+        while conn.out:
+            item = conn.out[0]
+            if isinstance(item, FileBody):
+                try:
+                    n = item.sendTo(conn.sock)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    self.closeConnection(conn)
+                    return
+                if not n:
+                    # The file was truncated, the response can't be completed
+                    self.closeConnection(conn)
+                    return
+                if not item.remaining:
+                    conn.out.popleft()
+                    item.close()
+                continue
+            if not isinstance(item, (bytes, bytearray, memoryview)):
+                # Next chunk of a streamed body, sent before the iterator
+                try:
+                    chunk = next(item)
+                except StopIteration:
+                    conn.out.popleft()
+                    conn.out.appendleft(b'0\r\n\r\n')
+                    continue
+                except Exception as e:
+                    print("HTTP: Warning: response body error: %s: %s" % (type(e).__name__, e))
+                    self.closeConnection(conn)
+                    return
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf8')
+                if chunk:
+                    conn.out.appendleft(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+                continue
+            try:
+                n = conn.sock.send(item)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.closeConnection(conn)
+                return
+            if n < len(item):
+                conn.out[0] = memoryview(item)[n:]
+                break
+            conn.out.popleft()
+
+        if not conn.out and conn.close_after:
+            self.closeConnection(conn)
+            return
+        self.setEvents(conn)
+
+
+
+# Static files handler
+STATIC_STAT_TTL = 1
+STATIC_MAX_RANGES = 16
+
+# Types missing or wrong in mimetypes
+static_types = {
+    '.ts': 'video/mp2t',
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.m4s': 'video/iso.segment',
+    '.mpd': 'application/dash+xml'
+}
+
+def parseRange(value, size):
+    # Returns the list of (start, end) byte ranges of a Range header, end
+    # included, [] when none is satisfiable and None when the header is
+    # invalid and must be ignored
+    unit, _, ranges = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    out = []
+    for spec in ranges.split(','):
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if last and end < start: return None
+            else:
+                suffix = int(last)
+                if suffix == 0: continue
+                start = max(size - suffix, 0)
+                end = size - 1
+        except ValueError:
+            return None
+        if start < size:
+            out.append((start, min(end, size - 1)))
+    if len(out) > STATIC_MAX_RANGES:
+        return None
+    # Overlapping ranges are a common abuse, serve the whole file instead
+    out_sorted = sorted(out)
+    for i in range(1, len(out_sorted)):
+        if out_sorted[i][0] <= out_sorted[i-1][1]:
+            return None
+    return out
+
+class StaticFiles():
+    # HTTPServer handler serving the files under root. Supports single and
+    # multiple byte ranges, conditional requests on ETag and Last-Modified
+    # with stat results cached for STATIC_STAT_TTL seconds, and precompressed
+    # ".gz" variants when the client accepts gzip.
+    def __init__(self, root, index='index.html', precompressed=True, max_age=None, cache_size=4096):
+        self.root = os.path.realpath(root)
+        self.index = index
+        self.precompressed = precompressed
+        self.max_age = max_age
+        self.cache_size = cache_size
+        self.stats = {}  # path -> (check time, stat result or None, etag)
+
+    def stat(self, path):
+        now = time.monotonic()
+        entry = self.stats.get(path)
+        if entry is not None and now - entry[0] < STATIC_STAT_TTL:
+            return entry[1], entry[2]
+        try:
+            st = os.stat(path)
+            if not stat.S_ISREG(st.st_mode): st = None
+        except OSError:
+            st = None
+        etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size) if st is not None else None
+        if len(self.stats) >= self.cache_size:
+            del self.stats[next(iter(self.stats))]
+        self.stats[path] = (now, st, etag)
+        return st, etag
+
+    def resolvePath(self, request_path):
+        path = urllib.parse.unquote(request_path.split('?', 1)[0].split('#', 1)[0])
+        path = os.path.realpath(os.path.join(self.root, path.lstrip('/')))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            return None
+        if os.path.isdir(path) and self.index:
+            path = os.path.join(path, self.index)
+        return path
+
+    def isNotModified(self, request, st, etag):
+        inm = getHeader(request['header'], 'if-none-match')
+        if inm is not None:
+            tags = [t.strip() for t in inm.split(',')]
+            return '*' in tags or etag in tags or ('W/' + etag) in tags
+        ims = getHeader(request['header'], 'if-modified-since')
+        if ims is not None:
+            try:
+                return int(st.st_mtime) <= email.utils.parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                pass
+        return False
+
+    def __call__(self, request):
+        if request['method'] not in ('GET', 'HEAD'):
+            return {'repcode': 405, 'header': {'Allow': 'GET, HEAD'}}
+
+        path = self.resolvePath(request['path'])
+        st, etag = self.stat(path) if path is not None else (None, None)
+        if st is None:
+            return {'repcode': 404, 'header': {'Content-Type': 'text/plain'}, 'body': 'Not Found'}
+
+        header = {}
+        content_type = static_types.get(os.path.splitext(path)[1].lower())
+        if content_type is None:
+            content_type, _ = mimetypes.guess_type(path)
+        header['Content-Type'] = content_type or 'application/octet-stream'
+
+        # Precompressed variant
+        if self.precompressed:
+            gz_st, gz_etag = self.stat(path + '.gz')
+            if gz_st is not None:
+                header['Vary'] = 'Accept-Encoding'
+                accepted = [e.split(';')[0].strip().lower() for e in (getHeader(request['header'], 'accept-encoding') or '').split(',')]
+                if 'gzip' in accepted:
+                    path, st, etag = path + '.gz', gz_st, gz_etag
+                    header['Content-Encoding'] = 'gzip'
+
+        header['ETag'] = etag
+        header['Last-Modified'] = email.utils.formatdate(st.st_mtime, usegmt=True)
+        header['Accept-Ranges'] = 'bytes'
+        if self.max_age is not None:
+            header['Cache-Control'] = 'max-age=%d' % self.max_age
+
+        if self.isNotModified(request, st, etag):
+            del header['Content-Type']
+            return {'repcode': 304, 'header': header}
+
+        # Ranges, ignored when If-Range doesn't match the current file
+        size = st.st_size
+        range_value = getHeader(request['header'], 'range')
+        if_range = getHeader(request['header'], 'if-range')
+        if if_range is not None and if_range != etag and if_range != header['Last-Modified']:
+            range_value = None
+        ranges = parseRange(range_value, size) if range_value is not None else None
+
+        if ranges is None:
+            return {'repcode': 200, 'header': header, 'body': FileBody(path, 0, size)}
+
+        if not ranges:
+            return {'repcode': 416, 'header': {'Content-Range': 'bytes */%d' % size}}
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            header['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            return {'repcode': 206, 'header': header, 'body': FileBody(path, start, end - start + 1)}
+
+        boundary = os.urandom(12).hex()
+        parts = []
+        for start, end in ranges:
+            parts.append( ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (boundary, header['Content-Type'], start, end, size)).encode('ascii') )
+            parts.append( FileBody(path, start, end - start + 1) )
+            parts.append( b'\r\n' )
+        parts.append( ('--%s--\r\n' % boundary).encode('ascii') )
+        header['Content-Type'] = 'multipart/byteranges; boundary=' + boundary
+        return {'repcode': 206, 'header': header, 'body': parts}
+
+
+# Multi-process server
+class PreforkServer():
+    # Runs workers HTTPServer processes forked from a supervisor. With
+    # reuse_port each worker binds its own SO_REUSEPORT socket and the kernel
+    # balances connections, otherwise the workers share the listening socket
+    # of the supervisor. SIGTERM/SIGINT stop gracefully, SIGHUP starts new
+    # workers then gracefully stops the old ones. Crashed workers are
+    # restarted.
+    def __init__(self, handler, host='', port=8080, workers=None, reuse_port=True, backlog=128, shutdown_timeout=5, unix_socket=None, **server_args):
+        # unix_socket: path to listen on instead of host and port, the
+        # workers then share the socket of the supervisor
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.workers = workers or os.cpu_count() or 1
+        self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT') and unix_socket is None
+        self.backlog = backlog
+        self.shutdown_timeout = shutdown_timeout
+        self.server_args = server_args
+        self.sock = None
+        self.children = {}  # pid -> worker index
+        self.stopping = False
+        self.restarting = False
+
+    def listenSocket(self):
+        if self.unix_socket is not None:
+            return listenUnix(self.unix_socket, self.backlog)
+        return socket.create_server((self.host, self.port), backlog=self.backlog, reuse_port=self.reuse_port)
+
+    def reserveSocket(self):
+        # Bound but not listening, so the kernel never hands it connections
+        sock = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        return sock
+
+    def runWorker(self, index):
+        # Child process, never returns
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            sock = self.listenSocket() if self.reuse_port else self.sock
+            if self.reuse_port and self.sock is not None:
+                self.sock.close()
+            server = HTTPServer(self.handler, sock=sock, **self.server_args)
+            signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+            server.listen()
+            server.serveForever()
+            server.shutdown(self.shutdown_timeout)
+        except BaseException as e:
+            print("HTTP: Warning: worker %d failed: %s: %s" % (index, type(e).__name__, e))
+            code = 1
+        finally:
+            os._exit(code)
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            self.runWorker(index)
+        self.children[pid] = index
+        return pid
+
+    def onSignal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.restarting = True
+        else:
+            self.stopping = True
+
+    def terminate(self, pids, timeout):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        end = time.monotonic() + timeout + 1
+        pids = set(pids)
+        while pids and time.monotonic() < end:
+            for pid in list(pids):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                        pids.discard(pid)
+                except ChildProcessError:
+                    pids.discard(pid)
+            time.sleep(0.05)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+    def serveForever(self, poll_interval=0.2):
+        # The supervisor socket is bound first in both modes so that binding
+        # errors are raised here rather than in every worker
+        if self.reuse_port:
+            self.sock = self.reserveSocket()
+            self.port = self.sock.getsockname()[1]
+        else:
+            self.sock = self.listenSocket()
+        previous = {signum: signal.signal(signum, self.onSignal) for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)}
+        crashes = collections.deque(maxlen=self.workers * 2)
+        try:
+            for index in range(self.workers):
+                self.spawn(index)
+            while not self.stopping:
+                if self.restarting:
+                    self.restarting = False
+                    old = list(self.children)
+                    for index in range(self.workers):
+                        self.spawn(index)
+                    for pid in old:
+                        del self.children[pid]
+                    self.terminate(old, self.shutdown_timeout)
+
+                # Restart crashed workers, slowing down when they crash in loop
+                while 1:
+                    try:
+                        pid, status = os.waitpid(-1, os.WNOHANG)
+                    except ChildProcessError:
+                        break
+                    if pid == 0:
+                        break
+                    index = self.children.pop(pid, None)
+                    if index is None or self.stopping:
+                        continue
+                    print("HTTP: Warning: worker %d exited with code %d, restarting" % (index, os.waitstatus_to_exitcode(status)))
+                    crashes.append(time.monotonic())
+                    if len(crashes) == crashes.maxlen and crashes[-1] - crashes[0] < 1:
+                        time.sleep(1)
+                    self.spawn(index)
+                time.sleep(poll_interval)
+        finally:
+            self.terminate(list(self.children), self.shutdown_timeout)
+            self.children = {}
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            self.sock.close()
+            self.sock = None
+            if self.unix_socket is not None:
+                try:
+                    os.unlink(self.unix_socket)
+                except OSError:
+                    pass
+
+
+
+# Test code
+'''
+http = HTTP()
+print( http.request("https://httpbin.org/get") )
+
+async def main():
+    http = AsyncHTTP(keep_alive=True)
+    reps = await asyncio.gather(*[http.request("https://httpbin.org/get") for _ in range(10)])
+    await http.closeAllConnection()
+asyncio.run(main())
+
+def handler(request):
+    return {'repcode': 200, 'header': {'Content-Type': 'text/plain'}, 'body': 'Hello ' + request['path']}
+HTTPServer(handler, port=8080).serveForever()
 '''